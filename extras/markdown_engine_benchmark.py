@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import time
+import difflib
+
+import frontmatter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from wmk import get_config, markdown_extensions_settings
+from wmk_utils import markdown_to_html, markdown_engine_name, MARKDOWN_ENGINES
+
+
+def load_documents(basedir):
+    """
+    Get (filename, body, extensions, extension_configs) for each markdown file
+    in the content directory of a wmk project. Shortcodes are left as is.
+    """
+    conf = get_config(basedir, 'wmk_config.yaml')
+    ctdir = os.path.join(basedir, 'content')
+    ret = []
+    for root, dirs, files in os.walk(ctdir):
+        for fn in sorted(files):
+            if not fn.endswith(('.md', '.mdwn', '.mdown', '.markdown', '.mdtext')):
+                continue
+            path = os.path.join(root, fn)
+            with open(path) as f:
+                meta, body = frontmatter.parse(f.read())
+            if meta.get('pandoc') or meta.get('markdown_engine'):
+                continue
+            extensions, extension_configs = markdown_extensions_settings(
+                meta, conf)
+            ret.append((path[len(ctdir)+1:], body,
+                        list(extensions), dict(extension_configs)))
+    return ret
+
+
+def normalize(html):
+    "Ignore whitespace differences between tags."
+    return re.sub(r'>\s+<', '><', html).strip()
+
+
+def run_engine(engine, docs, rounds=3):
+    "Returns (seconds_per_round, {filename: html})."
+    outputs = {}
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        for fn, body, ext, ext_conf in docs:
+            outputs[fn] = markdown_to_html(body, ext, ext_conf, engine=engine)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, outputs)
+
+
+def main(basedir, engines=None, show_diffs=0):
+    docs = load_documents(basedir)
+    if not docs:
+        print("No markdown documents found in %s/content" % basedir)
+        return
+    total_size = sum([len(_[1].encode('utf-8')) for _ in docs])
+    print("Corpus: %d documents, %.1f KB of markdown\n" % (
+        len(docs), total_size / 1024))
+    engines = engines or list(MARKDOWN_ENGINES.keys())
+    engines = [_ for _ in engines if markdown_engine_name(_) == _]
+    results = {}
+    for engine in engines:
+        results[engine] = run_engine(engine, docs)
+    reference = results.get('python-markdown')
+    print("%-16s %10s %10s %12s %12s" % (
+        'engine', 'time', 'docs/s', 'MB/s', 'differing'))
+    for engine in engines:
+        elapsed, outputs = results[engine]
+        differing = '-'
+        if reference and engine != 'python-markdown':
+            differing = len([
+                fn for fn in outputs
+                if normalize(outputs[fn]) != normalize(reference[1][fn])])
+        print("%-16s %9.3fs %10.0f %12.2f %12s" % (
+            engine, elapsed, len(docs) / elapsed,
+            total_size / elapsed / 1024**2, differing))
+    if not (reference and show_diffs):
+        return
+    for engine in engines:
+        if engine == 'python-markdown':
+            continue
+        shown = 0
+        for fn, html in results[engine][1].items():
+            ref_html = reference[1][fn]
+            if normalize(html) == normalize(ref_html):
+                continue
+            print("\n=== %s: %s" % (engine, fn))
+            diff = difflib.unified_diff(
+                ref_html.splitlines(), html.splitlines(),
+                'python-markdown', engine, lineterm='')
+            print('\n'.join(diff))
+            shown += 1
+            if shown >= show_diffs:
+                break
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    show_diffs = 0
+    if '--diff' in args:
+        idx = args.index('--diff')
+        if len(args) > idx + 1 and args[idx+1].isdigit():
+            show_diffs = int(args.pop(idx+1))
+        else:
+            show_diffs = 5
+        args.pop(idx)
+    basedir = args[0] if args else '.'
+    main(os.path.realpath(basedir), args[1:], show_diffs)
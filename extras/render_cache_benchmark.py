@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from wmk_utils import RenderCache, _zstd
+
+
+def load_corpus(basedir):
+    """
+    Get all (key, value) pairs from the render cache of an existing wmk
+    project, decoding compressed values as needed.
+    """
+    filename = RenderCache.cache_filename(basedir)
+    if not os.path.exists(filename):
+        print("ERROR: No render cache found at %s; build the site first" % filename)
+        sys.exit(1)
+    db = sqlite3.connect(filename)
+    cols = [_[1] for _ in db.execute("PRAGMA table_info(cache)")]
+    fmt_col = 'fmt' if 'fmt' in cols else 'NULL'
+    ret = []
+    for key, val, fmt in db.execute("SELECT key, val, %s FROM cache" % fmt_col):
+        try:
+            ret.append((key, RenderCache.decode_value(val, fmt)))
+        except ValueError:
+            continue
+    return ret
+
+
+def benchmark(corpus, compression, lookups):
+    "Returns (db_size, write_time, mean_lookup_time) for the given setting."
+    RenderCache.configure(compression=compression)
+    with tempfile.TemporaryDirectory() as projdir:
+        start = time.perf_counter()
+        for key, val in corpus:
+            cache = RenderCache('', '', projdir)
+            cache.key = key
+            cache.write_cache(val)
+        write_time = time.perf_counter() - start
+        keys = [random.choice(corpus)[0] for _ in range(lookups)]
+        start = time.perf_counter()
+        for key in keys:
+            cache = RenderCache('', '', projdir)
+            cache.key = key
+            cache.get_cache()
+        lookup_time = (time.perf_counter() - start) / lookups
+        cache.db.close()
+        RenderCache._local.connections.clear()
+        db_size = os.path.getsize(RenderCache.cache_filename(projdir))
+    return (db_size, write_time, lookup_time)
+
+
+def main(basedir, lookups):
+    corpus = load_corpus(basedir)
+    if not corpus:
+        print("The render cache is empty; nothing to measure")
+        return
+    raw_size = sum([len(v.encode('utf-8')) for k, v in corpus if isinstance(v, str)])
+    print("Corpus: %d entries, %.1f MB of uncompressed data; %d lookups\n" % (
+        len(corpus), raw_size / 1024**2, lookups))
+    print("%-6s %12s %10s %14s" % ('mode', 'db size', 'write', 'lookup'))
+    modes = ['none', 'zlib'] + (['zstd'] if _zstd else [])
+    for mode in modes:
+        db_size, write_time, lookup_time = benchmark(corpus, mode, lookups)
+        print("%-6s %9.2f MB %9.2fs %11.1f µs" % (
+            mode, db_size / 1024**2, write_time, lookup_time * 1e6))
+    if not _zstd:
+        print("\n(zstd not available; install the zstandard module to include it)")
+
+
+if __name__ == '__main__':
+    basedir = sys.argv[1] if len(sys.argv) > 1 else '.'
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    main(os.path.realpath(basedir), lookups)
@@ -0,0 +1,107 @@
+import os
+import sys
+import datetime
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wmk_utils import MDContentList, attrdict
+
+
+def make_item(i, **page):
+    page.setdefault('title', 'Page %d' % i)
+    return attrdict({
+        'url': '/p%d/' % i,
+        'source_file': '/content/p%d.md' % i,
+        'source_file_short': 'p%d.md' % i,
+        'target': '/htdocs/p%d/index.html' % i,
+        'template': 'md_base.mhtml',
+        'doc': 'Document %d' % i,
+        'rendered': '<p>Document %d</p>' % i,
+        'data': {
+            'page': attrdict(page),
+            'MTIME': datetime.datetime(2020, 1, 1),
+            'DATE': datetime.datetime(2020, 1, 1 + i % 28),
+        },
+    })
+
+
+class PageMatchSqlTest(unittest.TestCase):
+
+    def setUp(self):
+        # A derived list, whose order differs from that of the rows in the
+        # database it shares with the original list
+        items = [make_item(i, weight=i % 3, type='post' if i % 2 else 'page')
+                 for i in range(20)]
+        self.content = MDContentList(items)
+        self.derived = self.content.sorted_by('title', reverse=True)
+
+    def urls(self, lst):
+        return [_['url'] for _ in lst]
+
+    def test_unordered_keeps_list_order(self):
+        found = self.derived.page_match_sql("page_type = 'post'")
+        expected = [_ for _ in self.derived if _['data']['page']['type'] == 'post']
+        self.assertEqual(self.urls(found), self.urls(expected))
+
+    def test_ties_keep_list_order(self):
+        found = self.derived.page_match_sql(
+            "page_type = 'post'", order_by='page_weight', limit=5)
+        expected = sorted(
+            [_ for _ in self.derived if _['data']['page']['type'] == 'post'],
+            key=lambda x: x['data']['page']['weight'])[:5]
+        self.assertEqual(self.urls(found), self.urls(expected))
+        first = self.derived.page_match_sql(
+            "page_type = 'post'", order_by='page_weight DESC', first=True)
+        expected = sorted(
+            [_ for _ in self.derived if _['data']['page']['type'] == 'post'],
+            key=lambda x: x['data']['page']['weight'], reverse=True)[0]
+        self.assertEqual(first['url'], expected['url'])
+
+
+class ContentQueryTest(unittest.TestCase):
+    """
+    A query must give the same result as the corresponding chain of
+    MDContentList calls.
+    """
+
+    def make_list(self, rnd):
+        items = []
+        for i in range(60):
+            page = {'weight': rnd.randint(0, 3)}
+            if rnd.random() < 0.5:
+                page['tags'] = rnd.sample(['a', 'b', 'c'], rnd.randint(1, 2))
+            if rnd.random() < 0.3:
+                page['slug'] = rnd.choice(['x', 'y'])
+            items.append(make_item(i, **page))
+        rnd.shuffle(items)
+        return MDContentList(items)
+
+    def check(self, steps):
+        for seed in range(30):
+            lst = self.make_list(random.Random(seed))
+            expected = lst
+            query = lst.query()
+            for step in steps:
+                expected = step(expected)
+                query = step(query)
+            self.assertEqual([_['url'] for _ in query],
+                             [_['url'] for _ in expected], 'seed %d' % seed)
+
+    def test_page_match_list(self):
+        union = [{'has_tag': ['c']}, {'slug': 'x'}, {'has_tag': ['a']}]
+        self.check([lambda x: x.page_match(union),
+                    lambda x: x.has_tag(['b'])])
+        self.check([lambda x: x.page_match(union),
+                    lambda x: x.sorted_by('weight')])
+        self.check([lambda x: x.page_match(union),
+                    lambda x: x.sorted_by('weight')[:3]])
+        self.check([lambda x: x.sorted_by('weight', reverse=True),
+                    lambda x: x.page_match(union, limit=5)])
+        self.check([lambda x: x.has_tag(['b']),
+                    lambda x: x.page_match(union, ordering='-weight')])
+
+
+if __name__ == '__main__':
+    unittest.main()
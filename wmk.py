@@ -5,17 +5,22 @@ import sys
 import datetime
 import re
 import ast
+import copy
+import fnmatch
+import functools
 import json
 import subprocess
 import hashlib
 import shutil
 import locale
 import gettext
+import concurrent.futures
+import contextlib
+import threading
 
 import sass
 import yaml
 import frontmatter
-import markdown
 import pypandoc
 import lunr
 
@@ -24,12 +29,22 @@ from mako.exceptions import text_error_template, TemplateLookupException
 
 from wmk_utils import (
     slugify, attrdict, MDContentList, RenderCache, Nav, Toc, hookable,
-    dartsass_compile)
+    dartsass_compile, file_hash, markdown_to_html, PandocServer,
+    BackgroundJobs, PersistentContentDB)
 import wmk_mako_filters as wmf
 
 # To be imported from wmk_autoload and/or wmk_theme_autoload, if applicable
 autoload = {}
 
+# The configuration of the current build, for hookable functions which do not
+# receive it as an argument (see handle_taxonomy())
+build_conf = {}
+
+# Held while a page is rendered if several threads may do so at once; see
+# render_markdown_exclusively()
+_render_lock = threading.Lock()
+_render_state = threading.local()
+
 VERSION = '1.19.1'
 
 # Template variables with these names will be converted to date or datetime
@@ -167,10 +182,14 @@ def main(basedir=None, quick=False):
     process_templates(templates, lookup, template_vars, force)
     # 7) render Markdown/HTML/other content
     process_markdown_content(content, lookup, conf, force)
+    # Background jobs, such as extra pandoc output formats, must be done now
+    BackgroundJobs.wait()
     # 8) Cleanup/external post-processing stage
     if not quick:
         post_build_actions(conf, dirs, templates, content)
         run_cleanup_commands(conf, basedir)
+    # 9) Keep the render cache within the configured limits, if any
+    prune_render_cache(conf, basedir)
 
 
 def get_content_info(basedir='.', content_only=True):
@@ -245,6 +264,7 @@ def get_template_vars(dirs, themedir, conf, assets_map=None):
         'WEBROOT': os.path.realpath(dirs['output']),
         'TEMPLATES': [],
         'MDCONTENT': MDContentList([]),
+        'COLLECTIONS': attrdict({}),
         'CACHE': {}, # in-memory hash for caching in templates
     }
     template_vars.update(conf.get('template_context', {}))
@@ -748,8 +768,14 @@ def process_markdown_content(content, lookup, conf, force):
     """
     Renders the specified markdown content into the outputdir.
     """
+    global build_conf
+    build_conf = conf
     for ct in content:
-        if not force and is_older_than(ct['source_file'], ct['target']):
+        if not force and is_older_than(ct['source_file'], ct['target']) \
+                and all([is_older_than(fn, ct['target']) for fn in page_dependencies(
+                    ct['data']['page'], ct['data']['DATADIR'][:-5])]):
+            # Neither the source file nor the files it depends upon
+            # (included files, shortcode templates, etc.) have changed.
             continue
         try:
             template = None if ct['template'].lower() == '__empty__' \
@@ -767,61 +793,42 @@ def process_markdown_content(content, lookup, conf, force):
         data['CONTENT'] = html
         data['RAW_CONTENT'] = ct['doc']
         page = data['page']
-        global autoload
-        if page.POSTPROCESS and page._CACHER:
-            # NOTE: Because of the way we handle caching in the presence of
-            # postprocessing, the postprocess chain is potentially run twice
-            # for each applicable page: once before the Mako template is called,
-            # and once after. To prevent this, we use the `was_called`
-            # attribute which when present prevents the postprocessing from
-            # taking place after the template has been applied.
-            # AS A CONSEQUENCE, the range of application for a cached and a
-            # non-cached page will be slightly different in that a cached page
-            # will not apply the postprocessing code to the parts of the HTML
-            # supplied by the Mako template, only to the HTML directly converted
-            # from Markdown. For most purposes this will not matter. If it does
-            # for some specific page you will need to set `no_cache` to True
-            # in its frontmatter.
-            for pp in page.POSTPROCESS:
-                if isinstance(pp, str):
-                    if autoload and pp in autoload:
-                        html = autoload[pp](html, **data)
-                        autoload[pp].was_called = data['SELF_FULL_PATH']
-                    else:
-                        print("WARNING: postprocess action '%s' missing for %s"
-                              % (pp, ct['url']))
-                else:
-                    try:
-                        html = pp(html, **data)
-                        pp.was_called = data['SELF_FULL_PATH']
-                    except Exception as e:
-                        print("WARNING: postprocess failed for {}: {}".format(
-                            ct['source_file_short'], e))
-            page._CACHER(html)
-            ct['rendered'] = html
-            data['CONTENT'] = html
-        try:
-            data['TOC'] = Toc(html)
-        except Exception as e:
-            print("TOC ERROR for %s: %s" % (ct['url'], str(e)))
-            data['TOC'] = Toc('')
         html_output = ''
-        handle_taxonomy(data)
-        try:
-            if template is None:
-                html_output = data['CONTENT'] or ''
-            else:
-                html_output = template.render(**data)
-        except:
-            # TODO: Does not really make sense for Jinja template errors
-            print("WARNING: Error when rendering {}: {}".format(
-                ct['source_file_short'], text_error_template().render()))
+        page_cache_key = page_output_cache_key(ct, template, conf)
+        if page_cache_key:
+            page_cache = RenderCache(
+                page_cache_key, 'page_output', data['DATADIR'][:-5])
+            html_output = page_cache.get_cache() or ''
+        else:
+            page_cache = None
+        if not html_output:
+            try:
+                data['TOC'] = Toc(html)
+            except Exception as e:
+                print("TOC ERROR for %s: %s" % (ct['url'], str(e)))
+                data['TOC'] = Toc('')
+            handle_taxonomy(data)
+            try:
+                if template is None:
+                    html_output = data['CONTENT'] or ''
+                else:
+                    html_output = template.render(**data)
+            except:
+                # TODO: Does not really make sense for Jinja template errors
+                print("WARNING: Error when rendering {}: {}".format(
+                    ct['source_file_short'], text_error_template().render()))
+            if page_cache and html_output:
+                page_cache.write_cache(html_output)
         # If present, POSTPROCESS will have been added by a shortcode call
         if html_output and page.get('POSTPROCESS'):
             html_output = postprocess_html(page.POSTPROCESS, data, html_output)
         if html_output and not page.get('do_not_render', False):
-            with open(ct['target'], 'w') as f:
-                f.write(html_output)
+            if page_cache and file_has_content(ct['target'], html_output):
+                # Just mark it as up to date
+                os.utime(ct['target'])
+            else:
+                with open(ct['target'], 'w') as f:
+                    f.write(html_output)
             print('[%s] - content: %s' % (
                 str(datetime.datetime.now()), ct['source_file_short']))
         elif html_output:
@@ -831,6 +838,217 @@ def process_markdown_content(content, lookup, conf, force):
                 str(datetime.datetime.now()), ct['source_file_short']))
 
 
+# Context variables which are specific to each page.
+PAGE_CONTEXT_FIELDS = (
+    'page', 'CONTENT', 'RAW_CONTENT', 'SELF_URL', 'SELF_FULL_PATH',
+    'SELF_SHORT_PATH', 'SELF_TEMPLATE', 'MTIME', 'DATE')
+# Context variables which do not affect the page output cache key: TOC is
+# derived from CONTENT, while CACHE is only a memoization helper.
+PAGE_CACHE_IGNORED_FIELDS = ('TOC', 'CACHE', 'RENDERER', 'LOOKUP')
+# Fields added to `page` while rendering other pages, which are ignored when
+# digesting lists of pages: their order and values vary between builds.
+PAGE_BOOKKEEPING_FIELDS = ('DEPENDENCIES', 'POSTPROCESS', '_POSTPROCESS_CALLS')
+
+
+@hookable
+def page_output_cache_key(ct, template, conf):
+    """
+    If the page output cache is active for this content item, returns a string
+    which identifies the output of its template, i.e. a fingerprint of the
+    rendered body, the frontmatter, the template files involved (including
+    those it inherits from or includes) and the context variables which the
+    templates refer to. Otherwise returns None.
+
+    The cache is off unless `page_cache` is true in the configuration. It can be
+    turned off for individual pages with `page_cache: false`. Pages with a
+    TAXONOMY or templates which cannot be reliably analyzed (e.g. those calling
+    write_to() or paginate()) are never cached.
+    """
+    pg = ct['data']['page']
+    if template is None or not conf.get('use_cache', True) \
+            or not pg.get('page_cache', conf.get('page_cache', False)) \
+            or pg.get('no_cache') or pg.get('TAXONOMY'):
+        return None
+    memo = conf.setdefault('_page_cache_memo', {'templates': {}, 'values': {}})
+    info = template_info(template, memo['templates'])
+    if info is None:
+        return None
+    data = ct['data']
+    names = set(data.keys() if info['names'] is None else info['names'])
+    names = (names | set(['page', 'CONTENT', 'SELF_URL'])) \
+        - set(PAGE_CACHE_IGNORED_FIELDS)
+    digests = context_digests(data, names, memo['values'])
+    if digests is None:
+        return None
+    return json.dumps(
+        [ct['template'], sorted([file_hash(fn) for fn in info['files']]),
+         digests], sort_keys=True)
+
+
+def context_digests(data, names, memo):
+    """
+    A dict of the digests (see context_digest()) of the context variables
+    `names` in `data`, or None if any of them cannot be computed. The digests
+    of values which are shared between pages are memoized in `memo`.
+    """
+    digests = {}
+    for name in sorted(names):
+        val = data.get(name)
+        if name == 'site' and isinstance(val, dict):
+            # Cached pages keep the build_time of their original build
+            val = attrdict(dict([(k, v) for k, v in val.items()
+                                 if k != 'build_time']))
+        if name in PAGE_CONTEXT_FIELDS or name == 'site':
+            digests[name] = context_digest(val)
+        else:
+            # The same object is shared between pages
+            memo_key = (name, id(val))
+            if memo_key not in memo:
+                memo[memo_key] = (val, context_digest(val))
+            digests[name] = memo[memo_key][1]
+        if digests[name] is None:
+            return None
+    return digests
+
+
+def template_info(template, memo=None):
+    """
+    Static analysis of a Mako or Jinja2 page template for the page output cache.
+    Returns a dict with the keys `files` (the template files involved) and
+    `names` (the context variables they refer to, or None if they may access
+    the whole context) or None if the template is not suitable for caching.
+    """
+    memo = {} if memo is None else memo
+    fn = template.filename
+    if fn in memo:
+        return memo[fn]
+    memo[fn] = None  # in case of circular references
+    ret = {'files': [fn], 'names': set()}
+    if hasattr(template, 'code'):
+        # Mako: look at the generated python module
+        code = template.code
+        lookup = template.lookup
+        if re.search(r'\b(?:write_to|paginate|get_template)\b', code):
+            return None
+        # Variables are looked up with context.get('name', ...) in the
+        # generated code, while templates may also use context['name'] or
+        # context.get("name"). Any other access may concern any variable.
+        if re.search(r'\bcontext\.(?:kwargs|keys|items|values)\b', code) \
+                or re.search(
+                    r"""\bcontext(?:\[|\.get\()(?!\s*(['"])\w+\1)""", code):
+            ret['names'] = None
+        else:
+            ret['names'].update([_[1] for _ in re.findall(
+                r"""\bcontext(?:\[|\.get\()\s*(['"])(\w+)\1""", code)])
+        refs = re.findall(
+            r"\b(?:_inherit_from|_include_file|_lookup_template)\(context, ([^,]+),",
+            code)
+        refs += re.findall(r"\btempl(?:ate)?uri=([^,)]+)", code)
+        get_sub = lambda x: lookup.get_template(
+            lookup.adjust_uri(x, template.uri))
+    else:
+        from jinja2 import meta
+        env = template.environment
+        source = env.loader.get_source(env, template.name)[0]
+        if re.search(r'\b(?:write_to|paginate|get_template|mako_lookup)\b', source):
+            return None
+        ast = env.parse(source)
+        names = meta.find_undeclared_variables(ast)
+        ret['names'] = None if 'get_context' in names else names
+        refs = [repr(_) if _ else '?'
+                for _ in meta.find_referenced_templates(ast)]
+        get_sub = env.get_template
+    for ref in set(refs):
+        if not re.match(r"^'[^']+'$", ref.strip()):
+            # Not a literal, so we do not know which template this is
+            return None
+        sub = template_info(get_sub(ref.strip()[1:-1]), memo)
+        if sub is None:
+            return None
+        ret['files'] += [_ for _ in sub['files'] if _ not in ret['files']]
+        if ret['names'] is not None and sub['names'] is not None:
+            ret['names'].update(sub['names'])
+        else:
+            ret['names'] = None
+    memo[fn] = ret
+    return ret
+
+
+def context_digest(val):
+    """
+    A stable SHA1 digest of a value in the template context (or None if it
+    cannot be computed).
+    """
+    if isinstance(val, MDContentList):
+        summary = []
+        for it in val:
+            data = it['data']
+            pg = data.get('page')
+            if isinstance(pg, dict) and any(
+                    [_ in pg for _ in PAGE_BOOKKEEPING_FIELDS]):
+                pg = dict([(k, v) for k, v in pg.items()
+                           if k not in PAGE_BOOKKEEPING_FIELDS])
+            summary.append({
+                'url': it.get('url'), 'source': it.get('source_file_short'),
+                'page': pg, 'date': data.get('DATE'),
+                'mtime': data.get('MTIME'), 'rendered': it.get('rendered')})
+        val = summary
+    elif isinstance(val, dict) and _has_content_list(val):
+        # E.g. COLLECTIONS
+        val = dict([(str(k), context_digest(v)) for k, v in val.items()])
+        if None in val.values():
+            return None
+    elif isinstance(val, (list, tuple)) and _has_content_list(val):
+        # E.g. TAXONS
+        val = [context_digest(_) for _ in val]
+        if None in val:
+            return None
+    try:
+        ret = json.dumps(val, sort_keys=True, default=_digestable)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(ret.encode('utf-8')).hexdigest()
+
+
+def _has_content_list(val):
+    # Helper for context_digest()
+    if isinstance(val, MDContentList):
+        return True
+    elif isinstance(val, dict):
+        return any([_has_content_list(_) for _ in val.values()])
+    elif isinstance(val, (list, tuple)):
+        return any([_has_content_list(_) for _ in val])
+    return False
+
+
+def _digestable(obj):
+    # Helper for context_digest()
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    elif isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        # Closures (e.g. filters created for the current settings) also depend
+        # upon the values they have been bound to.
+        return ['%s.%s' % (getattr(obj, '__module__', ''), obj.__qualname__)] \
+            + [_.cell_contents for _ in (getattr(obj, '__closure__', None) or [])]
+    elif hasattr(obj, '__dict__'):
+        # E.g. Nav objects; back-references would make this circular
+        ret = dict([(k, v) for k, v in vars(obj).items()
+                    if k not in ('parent', 'next', 'previous')])
+        ret['__class__'] = type(obj).__name__
+        return ret
+    raise TypeError('Not digestable: %r' % obj)
+
+
+def file_has_content(fn, content):
+    "Whether the text file `fn` exists and contains exactly `content`."
+    if not os.path.exists(fn) or os.path.getsize(fn) < len(content):
+        return False
+    with open(fn) as f:
+        return f.read() == content
+
+
 @hookable
 def handle_taxonomy(data):
     """
@@ -838,17 +1056,23 @@ def handle_taxonomy(data):
       called immediately after this in the flow.
     - Writes a page (using the MDContentList write_to() method) for each taxon
       with TAXON (== CHUNK) and TAXON_INDEX (indicating its ordering in TAXONS)
-      in the context.
+      in the context. If `taxonomy_workers` is set to more than 1, the pages
+      are rendered by that many threads. If the page output cache is active
+      (see `page_cache` in the readme), pages whose fingerprint (see
+      taxon_page_fingerprint()) has not changed since the last build and whose
+      output file is intact are skipped.
     - No return value.
     """
     txy = data['page'].TAXONOMY
     if txy and 'taxon' in txy:
+        conf = build_conf or {}
         detail_template = txy.get('detail_template', data['page'].template)
         txy.valid = True
         maybe_order = {'order': txy['order']} if txy['order'] else {}
         taxons = data['MDCONTENT'].taxonomy_info(txy['taxon'], **maybe_order)
         data['TAXONS'] = taxons
         base_url = data['SELF_URL']
+        jobs = []
         for i, tx in enumerate(taxons):
             # NOTE: Assumes normal pretty_path setting!
             dest = re.sub(r'/index.html$',
@@ -860,17 +1084,82 @@ def handle_taxonomy(data):
             ctx = dict(**data)
             ctx['SELF_TEMPLATE'] = detail_template
             tx['url'] = dest
-            tx['items'].write_to(
-                dest=dest,
-                context=ctx,
-                extra_kwargs={'TAXON': tx, 'TAXON_INDEX': i},
-                template=detail_template)
+            jobs.append((tx, dest, ctx, {'TAXON': tx, 'TAXON_INDEX': i}))
+        projectdir = data['DATADIR'][:-5]
+        caches = {}
+        pending = []
+        for tx, dest, ctx, extra_kwargs in jobs:
+            fingerprint = taxon_page_fingerprint(
+                ctx, detail_template, extra_kwargs, conf)
+            if fingerprint:
+                cache = RenderCache(fingerprint, 'taxon_page', projectdir)
+                full_path = os.path.join(data['WEBROOT'], dest.strip('/'))
+                known = cache.get_cache()
+                if known and known == file_hash(full_path):
+                    continue
+                caches[dest] = (cache, full_path)
+            pending.append((tx, dest, ctx, extra_kwargs))
+        render = lambda job: job[0]['items'].write_to(
+            dest=job[1], context=job[2], extra_kwargs=job[3],
+            template=detail_template)
+        workers = int(conf.get('taxonomy_workers', 1))
+        if workers < 2 or len(pending) < 2:
+            for job in pending:
+                render(job)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+                # Raises the first exception (if any) in the original order
+                list(ex.map(render, pending))
+        for cache, full_path in caches.values():
+            cache.write_cache(file_hash(full_path))
     elif txy:
         print("WARNING: BAD TAXONOMY for", data['SELF_URL'])
         txy.valid = False
         data['TAXONS'] = []
 
 
+@hookable
+def taxon_page_fingerprint(ctx, template_name, extra_kwargs, conf):
+    """
+    A string identifying the output of a taxon page written by
+    handle_taxonomy(), based on the template files involved, the taxon
+    (including the pages belonging to it) and those variables in the context
+    `ctx` which the templates refer to; or None if the page should always be
+    rendered. This requires the page output cache to be active for the page
+    with the TAXONOMY.
+    """
+    pg = ctx['page']
+    if not conf.get('use_cache', True) \
+            or not pg.get('page_cache', conf.get('page_cache', False)) \
+            or pg.get('no_cache'):
+        return None
+    lookup = ctx.get('LOOKUP') or conf.get('_lookup')
+    if lookup is None:
+        return None
+    try:
+        template = lookup.get_template(template_name)
+    except TemplateLookupException:
+        template = lookup.get_template('base/' + template_name)
+    memo = conf.setdefault('_page_cache_memo', {'templates': {}, 'values': {}})
+    info = template_info(template, memo['templates'])
+    if info is None:
+        return None
+    names = set(ctx.keys() if info['names'] is None else info['names'])
+    # SELF_URL and CHUNK are the url and items of TAXON
+    names = (names | set(['page'])) - set(PAGE_CACHE_IGNORED_FIELDS) \
+        - set(['SELF_URL', 'CHUNK']) - set(extra_kwargs)
+    digests = context_digests(ctx, names, memo['values'])
+    if digests is None:
+        return None
+    digests['TAXON'] = context_digest(extra_kwargs['TAXON'])
+    if digests['TAXON'] is None:
+        return None
+    return json.dumps(
+        [template_name, sorted([file_hash(fn) for fn in info['files']]),
+         digests, extra_kwargs['TAXON_INDEX']],
+        sort_keys=True)
+
+
 @hookable
 def postprocess_html(ppr, data, html):
     """
@@ -919,6 +1208,7 @@ def render_markdown(ct, conf):
     extensions, extension_configs = markdown_extensions_settings(pg, conf)
     is_html = pg.get('_is_html', ct.get('source_file', '').endswith('.html'))
     is_pandoc = pg.get('pandoc', conf.get('pandoc', False))
+    markdown_engine = pg.get('markdown_engine', conf.get('markdown_engine'))
     pandoc_filters = pg.get('pandoc_filters', conf.get('pandoc_filters')) or []
     pandoc_options = pg.get('pandoc_options', conf.get('pandoc_options')) or []
     # This should be a markdown/commonmark subformat or gfm, unless the
@@ -929,17 +1219,30 @@ def render_markdown(ct, conf):
     pandoc_output = pg.get('pandoc_output_format',
                            conf.get('pandoc_output_format')) or 'html'
     use_cache = conf.get('use_cache', True) and not pg.get('no_cache', False)
+    projectdir = ct['data']['DATADIR'][:-5] # remove /data from the end
     if use_cache:
         mtime_matters = pg.get('cache_mtime_matters',
                                conf.get('cache_mtime_matters', False))
         maybe_mtime = ct['data']['MTIME'] if mtime_matters else None
-        optstr = str([target, extensions, extension_configs,
+        # Paths are relative to the project so that cache entries can be shared
+        rel_target = os.path.relpath(target, projectdir) if target else target
+        optstr = str([rel_target, extensions, extension_configs,
                       is_pandoc, pandoc_filters, pandoc_options,
-                      pandoc_input, pandoc_output, maybe_mtime])
-        projectdir = ct['data']['DATADIR'][:-5] # remove /data from the end
+                      pandoc_input, pandoc_output, maybe_mtime]
+                     + ([markdown_engine] if markdown_engine else []))
         cache = RenderCache(doc, optstr, projectdir)
         ret = cache.get_cache()
         if ret:
+            # Restore the page state that the shortcodes would have set up
+            if cache.meta.get('deps'):
+                # Merged with those given in the frontmatter (if any)
+                known = page_dependencies(pg, projectdir)
+                for fn in cache.dependencies():
+                    if os.path.normpath(fn) not in known:
+                        add_page_dependency(pg, fn)
+            if cache.meta.get('postprocess'):
+                replay_postprocess_shortcodes(
+                    cache.meta['postprocess'], conf, data)
             return ret
     else:
         ret = None
@@ -963,19 +1266,12 @@ def render_markdown(ct, conf):
     # POSTPROCESS, on the other hand may be added by shortcodes (and often is)
     if '{{<' in doc:
         # SHORTCODES:
-        # We need to handle include() first.
-        incpat = r'{{<[ \n\r\t]*(include)\(\s*(.*?)\s*\)\s*>}}'
-        incfound = re.search(incpat, doc, re.DOTALL)
-        while incfound:
-            doc = re.sub(incpat, handle_shortcode(conf, data, nth), doc, flags=re.DOTALL)
-            incfound = re.search(incpat, doc, re.DOTALL)
-        # Now other shortcodes.
-        # funcname, argstring
-        pat = r'{{<[ \n\r\t]*(\w+)\(\s*(.*?)\s*\)\s*>}}'
-        found = re.search(pat, doc, re.DOTALL)
-        while found:
-            doc = re.sub(pat, handle_shortcode(conf, data, nth), doc, flags=re.DOTALL)
-            found = re.search(pat, doc, re.DOTALL)
+        # We need to handle include() first, then other shortcodes.
+        replacer = handle_shortcode(conf, data, nth)
+        doc = expand_shortcodes(
+            doc, replacer, SHORTCODE_INCLUDE_PAT, ct.get('source_file_short'))
+        doc = expand_shortcodes(
+            doc, replacer, SHORTCODE_PAT, ct.get('source_file_short'))
     if is_html:
         ret = doc
     elif is_pandoc:
@@ -986,9 +1282,9 @@ def render_markdown(ct, conf):
         need_toc = (
             pg.get('toc', False)
             and re.search(r'^\[TOC\]$', doc, flags=re.M))
+        base_pandoc_options = list(pandoc_options)
         if need_toc:
-            if not pandoc_options:
-                pandoc_options = []
+            pandoc_options = list(pandoc_options or [])
             pandoc_options.append('--toc')
             pandoc_options.append('--standalone')
             toc_depth = ct['data']['page'].get('toc_depth')
@@ -1005,42 +1301,110 @@ def render_markdown(ct, conf):
         if pandoc_options:
             popt['extra_args'] = pandoc_options
         pd_doc = doc_with_yaml(pg, doc)
-        ret = pypandoc.convert_text(
-            pd_doc, pandoc_output, format=pandoc_input, **popt)
-        if need_toc:
-            offset = ret.find('</nav>') + 6
-            toc = ret[:offset]
-            ret = re.sub(r'<p>\[TOC\]</p>', toc, ret[offset:], flags=re.M)
         # map from format to target filename, e.g. {'pdf': 'subdir/myfile.pdf'}
         pdformats = pg.get('pandoc_extra_formats', {})
         # map from format to pandoc args: what to do for each format;
         # passed directly on to pypandoc. Keys: extra_args, filters
         pdformats_conf = pg.get('pandoc_extra_formats_settings', {})
+        # For non-markdown formats, the HTML has normally been produced along
+        # with the metadata already (see pandoc_metadata()).
+        combined = None
+        if doc == ct['doc'] and ct.get('source_file') \
+                and not re.search(r'mark|gfm', pandoc_input):
+            combined = pandoc_html_with_metadata(
+                doc, ct['source_file'], pandoc_input, projectdir,
+                pandoc_output, pandoc_filters, base_pandoc_options,
+                bool(need_toc), pg.get('toc_depth') if need_toc else None,
+                lookup_only=True, use_cache=use_cache)
+        if combined:
+            ret = combined[1]
+        else:
+            ret = pandoc_convert_text(
+                pd_doc, pandoc_output, format=pandoc_input, **popt)
+        if need_toc:
+            offset = ret.find('</nav>') + 6
+            toc = ret[:offset]
+            ret = re.sub(r'<p>\[TOC\]</p>', toc, ret[offset:], flags=re.M)
         if pdformats:
-            # NOTE: pd_doc will not include the output of shortcodes that affect
-            #       POSTPROCESS, notably linkto and pagelist.
+            # NOTE: pd_doc will not include the output of shortcodes that
+            #       affect POSTPROCESS, notably linkto and pagelist.
             pandoc_extra_formats(
                 pd_doc, pandoc_input,
                 pdformats, pdformats_conf,
-                ct['data']['WEBROOT'], ct['source_file_short'])
+                ct['data']['WEBROOT'], ct['source_file_short'],
+                projectdir)
     else:
-        ret = markdown.markdown(
-            doc, extensions=extensions, extension_configs=extension_configs)
-    if cache and pg.POSTPROCESS:
-        # Delay caching until just before calling the template
-        pg._CACHER = lambda x: cache.write_cache(x)
-    elif cache:
-        cache.write_cache(ret)
+        ret = markdown_to_html(
+            doc, extensions=extensions, extension_configs=extension_configs,
+            engine=markdown_engine)
+    if cache:
+        # Shortcode placeholders for POSTPROCESS are cached unresolved, along
+        # with the shortcode calls needed for recreating the POSTPROCESS
+        # actions on a cache hit.
+        cache.write_cache(ret, {
+            'deps': page_dependencies(pg, projectdir),
+            'postprocess': pg.get('_POSTPROCESS_CALLS')})
+    return ret
+
+
+def page_dependencies(pg, projectdir):
+    """
+    Full paths of the files which the rendered page depends upon, i.e. those in
+    `page.DEPENDENCIES`. These are the shortcode templates it uses, any files it
+    includes, as well as any other files (e.g. in data/) registered by
+    shortcodes or listed in the frontmatter. Relative paths are interpreted as
+    being relative to the project directory.
+    """
+    deps = pg.get('DEPENDENCIES') or []
+    if isinstance(deps, str):
+        deps = [deps]
+    ret = []
+    for fn in deps:
+        if not os.path.isabs(fn):
+            fn = os.path.join(projectdir, fn)
+        fn = os.path.normpath(fn)
+        if fn not in ret:
+            ret.append(fn)
     return ret
 
 
+def add_page_dependency(pg, filename):
+    "Register a file which the rendered output of the page depends upon."
+    if not pg.get('DEPENDENCIES'):
+        pg['DEPENDENCIES'] = []
+    elif isinstance(pg['DEPENDENCIES'], str):
+        pg['DEPENDENCIES'] = [pg['DEPENDENCIES']]
+    if filename and filename not in pg['DEPENDENCIES']:
+        pg['DEPENDENCIES'].append(filename)
+
+
+def replay_postprocess_shortcodes(calls, conf, data):
+    """
+    Calls the shortcodes that added POSTPROCESS actions to a page again, so as
+    to set them up for a page whose HTML is retrieved from the cache. `calls`
+    is a list of (name, argstr, nth) entries. The output of the shortcodes is
+    discarded, since the cached HTML already contains it.
+    """
+    nth = {}
+    replacer = handle_shortcode(conf, data, nth)
+    for name, argstr, num in calls:
+        nth[name] = num - 1
+        match = SHORTCODE_PAT.match('{{< %s(%s) >}}' % (name, argstr))
+        if match:
+            replacer(match)
+
+
 @hookable
 def pandoc_extra_formats(
-        doc, pandoc_input, pdformats, pdformats_conf, webroot, sourcefile):
+        doc, pandoc_input, pdformats, pdformats_conf, webroot, sourcefile,
+        projectdir=None):
     """
     Writes extra pandoc output formats (pdf, docx, ...) to the files specified
     in `pdformats` with the optional configuration (extra_args, filters) specified
-    in `pdformats_conf`.
+    in `pdformats_conf`. Output files are left alone if they were generated
+    from the same document with the same settings (including any files named
+    in them, e.g. Lua filters) and have not been changed since. The others are
+    generated as background jobs which are finished before the build ends.
     """
     for fmt in pdformats:
         cnf = pdformats_conf.get(fmt, {})
@@ -1059,13 +1423,99 @@ def pandoc_extra_formats(
                   % (sourcefile, fmt))
             continue
         outputfile = os.path.join(webroot, out_fn)
+        setting_files = [
+            _ for _ in list(filters) + [str(a).split('=', 1)[-1] for a in extra_args]
+            if os.path.isfile(_)]
+        optstr = str([pandoc_input, fmt, list(extra_args), list(filters), out_fn,
+                      [file_hash(_) for _ in setting_files], 'extra_format'])
+        if os.path.exists(outputfile) and file_hash(outputfile) == \
+                RenderCache(doc, optstr, projectdir).get_cache():
+            continue
         maybe_mkdir(outputfile)
-        pypandoc.convert_text(
-            doc, to=fmt, format=pandoc_input,
-            extra_args=extra_args, filters=filters,
-            outputfile=outputfile)
-        print('[%s] - extra: %s' % (
-                str(datetime.datetime.now()), out_fn))
+        BackgroundJobs.submit(
+            write_extra_format, doc, pandoc_input, fmt, extra_args, filters,
+            outputfile, out_fn, optstr, projectdir)
+
+
+def write_extra_format(doc, pandoc_input, fmt, extra_args, filters,
+                       outputfile, out_fn, optstr, projectdir):
+    # Helper for pandoc_extra_formats()
+    pandoc_convert_text(
+        doc, to=fmt, format=pandoc_input,
+        extra_args=extra_args, filters=filters,
+        outputfile=outputfile)
+    RenderCache(doc, optstr, projectdir).write_cache(file_hash(outputfile))
+    print('[%s] - extra: %s' % (
+            str(datetime.datetime.now()), out_fn))
+
+
+def render_markdown_exclusively(ct, conf):
+    """
+    Calls render_markdown() while holding a lock, so that shortcodes,
+    preprocessors and hooks still run one page at a time when pages are
+    rendered by several threads (see get_content()). Only the pandoc
+    conversions themselves run concurrently, since the lock is released while
+    waiting for pandoc (see render_lock_released()).
+    """
+    with _render_lock:
+        _render_state.locked = True
+        try:
+            return render_markdown(ct, conf)
+        finally:
+            _render_state.locked = False
+
+
+@contextlib.contextmanager
+def render_lock_released():
+    "Lets other threads render pages while this one is waiting for pandoc."
+    if getattr(_render_state, 'locked', False):
+        _render_lock.release()
+        try:
+            yield
+        finally:
+            _render_lock.acquire()
+    else:
+        yield
+
+
+@hookable
+def pandoc_convert_text(source, to, format, extra_args=(), filters=None,
+                        outputfile=None):
+    """
+    Like `pypandoc.convert_text()`, but uses the pandoc server (see the
+    `pandoc_server` setting) when possible. Filters always require pypandoc.
+    """
+    with render_lock_released():
+        server = None if filters else PandocServer.get()
+        ret = server.convert(source, to, format, extra_args) if server else None
+        if ret is None:
+            return pypandoc.convert_text(
+                source, to, format=format, extra_args=extra_args or (),
+                filters=filters, outputfile=outputfile)
+    if outputfile:
+        with open(outputfile, 'wb' if isinstance(ret, bytes) else 'w') as f:
+            f.write(ret)
+        return ''
+    return ret
+
+
+@hookable
+def pandoc_convert_file(source_file, to, format, extra_args=(), filters=None,
+                        outputfile=None):
+    "Like `pypandoc.convert_file()`, but see `pandoc_convert_text()`."
+    with render_lock_released():
+        server = None if filters else PandocServer.get()
+        ret = server.convert(
+            source_file, to, format, extra_args, is_file=True) if server else None
+        if ret is None:
+            return pypandoc.convert_file(
+                source_file, to, format=format, extra_args=extra_args or (),
+                filters=filters, outputfile=outputfile)
+    if outputfile:
+        with open(outputfile, 'wb' if isinstance(ret, bytes) else 'w') as f:
+            f.write(ret)
+        return ''
+    return ret
 
 
 @hookable
@@ -1284,25 +1734,52 @@ def get_index_yaml_data(ctdir, datadir):
 
 
 @hookable
-def pandoc_metadata(doc, fn, fmt, projectdir):
+def pandoc_metadata(doc, fn, fmt, projectdir, conf=None, meta=None):
     """
     Returns the parsed and converted metadata for the standard Pandoc metadata
     fields (mostly title, date and author). The input format is always a
     text-based one with native non-YAML metadata (i.e. currently org, rst,
     latex, man, rtf, xml/jats, tei or docbook).
+
+    If `conf` is given, the HTML for the document is produced in the same
+    pandoc run (see `pandoc_html_with_metadata()`), based on the pandoc
+    settings in `conf` and `meta` (the metadata known so far). This is only
+    done if the rendering cache is in use for the document, since that is how
+    the HTML is handed on to render_markdown().
     """
+    meta = meta or {}
+    use_cache = conf is not None and conf.get('use_cache', True) \
+        and not meta.get('no_cache', False)
+    if use_cache:
+        need_toc = bool(meta.get('toc', False)
+                        and re.search(r'^\[TOC\]$', doc, flags=re.M))
+        found = pandoc_html_with_metadata(
+            doc, fn, fmt, projectdir,
+            meta.get('pandoc_output_format',
+                     conf.get('pandoc_output_format')) or 'html',
+            meta.get('pandoc_filters', conf.get('pandoc_filters')) or [],
+            meta.get('pandoc_options', conf.get('pandoc_options')) or [],
+            need_toc, meta.get('toc_depth') if need_toc else None,
+            use_cache=use_cache)
+        if found:
+            return found[0]
     tmpdir = os.path.join(projectdir, 'tmp')
     if not os.path.isdir(tmpdir):
         os.makedirs(tmpdir)
     meta_json_tpl = os.path.join(tmpdir, 'meta-json.tpl')
     if not os.path.exists(meta_json_tpl):
-        with open(meta_json_tpl, 'w') as f:
+        # Written atomically, since this may run in several threads at once
+        tmp_tpl = '%s.%d.%d' % (
+            meta_json_tpl, os.getpid(), threading.get_ident())
+        with open(tmp_tpl, 'w') as f:
             f.write('$meta-json$')
-    cache = RenderCache(doc, str([fn, 'pandoc_metadata']), projectdir)
+        os.replace(tmp_tpl, meta_json_tpl)
+    cache = RenderCache(
+        doc, str([os.path.relpath(fn, projectdir), 'pandoc_metadata']), projectdir)
     ret = cache.get_cache()
     if ret:
         return json.loads(ret)
-    ret = pypandoc.convert_file(
+    ret = pandoc_convert_file(
         fn,
         'html',
         format=fmt,
@@ -1311,20 +1788,68 @@ def pandoc_metadata(doc, fn, fmt, projectdir):
     return json.loads(ret)
 
 
+@hookable
+def pandoc_html_with_metadata(doc, fn, fmt, projectdir, output, filters,
+                              extra_args, need_toc=False, toc_depth=None,
+                              lookup_only=False, use_cache=True):
+    """
+    Converts a document in a non-markdown format into HTML and at the same time
+    extracts its metadata, in one pandoc run. Returns a tuple of (metadata,
+    html) or None, which is also the return value if `lookup_only` is true and
+    the result is not in the cache. The html is exactly what render_markdown()
+    would get from pandoc with the same settings, so it can use it rather than
+    running pandoc again. If `use_cache` is false (i.e. `use_cache` is off in
+    the config or `no_cache` is set for the page), the cache is neither read
+    nor written.
+    """
+    if [_ for _ in extra_args
+            if str(_).split('=')[0] in ('--template', '-s', '--standalone')]:
+        return None
+    cache = None
+    if use_cache:
+        cache = RenderCache(doc, str([
+            os.path.relpath(fn, projectdir), fmt, output, filters, extra_args,
+            need_toc, toc_depth, 'pandoc_html_with_metadata']), projectdir)
+        ret = cache.get_cache()
+        if ret:
+            ret = json.loads(ret)
+            return (ret['meta'], ret['html'])
+    if lookup_only:
+        return None
+    tpl = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), 'aux',
+        'pandoc-meta-and-toc.html' if need_toc else 'pandoc-meta-and-body.html')
+    args = list(extra_args) + ['--template=%s' % tpl]
+    if need_toc:
+        args.append('--toc')
+        if toc_depth:
+            args.append('--toc-depth=%s' % toc_depth)
+    ret = pandoc_convert_text(
+        doc, output, format=fmt, extra_args=args, filters=filters or None)
+    meta_json, sep, html = ret.partition('<!-- wmk:end-of-meta -->\n')
+    if not sep:
+        return None
+    meta = json.loads(meta_json)
+    if cache:
+        cache.write_cache(json.dumps({'meta': meta, 'html': html}))
+    return (meta, html)
+
+
 @hookable
 def binary_to_markdown(fn, fmt, projectdir=None):
     "Convert a docx/odt/epub file to markdown for further processing."
     if projectdir:
-        st = os.stat(fn)
-        fkey = '%d-%d' % (st.st_size, st.st_mtime)
-        cache = RenderCache(fkey, str([fn, fmt, 'binary-to-markdown']), projectdir)
+        # Keyed on contents rather than mtime so that it survives a fresh checkout
+        fkey = file_hash(fn)
+        cache = RenderCache(fkey, str([os.path.relpath(fn, projectdir), fmt,
+                                       'binary-to-markdown']), projectdir)
         doc = cache.get_cache()
         if not doc:
-            doc = pypandoc.convert_file(
+            doc = pandoc_convert_file(
                 fn, 'markdown', format=fmt, extra_args=['--standalone'])
             cache.write_cache(doc)
     else:
-        doc = pypandoc.convert_file(
+        doc = pandoc_convert_file(
             fn, 'markdown', format=fmt, extra_args=['--standalone'])
     meta, doc = frontmatter.parse(doc)
     meta = maybe_extra_meta(meta, fn)
@@ -1355,6 +1880,8 @@ def get_content(ctdir, datadir, outputdir, template_vars, conf,
     """
     Get those markdown files that need processing.
     """
+    configure_render_cache(conf, os.path.dirname(os.path.realpath(datadir)))
+    PandocServer.configure(conf.get('pandoc_server'))
     content = []
     known_ids = set()
     content_extensions = get_content_extensions(conf)
@@ -1366,57 +1893,65 @@ def get_content(ctdir, datadir, outputdir, template_vars, conf,
         files_to_process = [(ctdir, [], [previewing])]
     else:
         files_to_process = [_ for _ in os.walk(ctdir)]
+    sources = []
     for root, dirs, files in files_to_process:
         for fn in files:
             if not fn.endswith(known_exts):
                 continue
             if fn.startswith('_') or fn.startswith('.'):
                 continue
-            source_file = os.path.join(root, fn)
-            source_file_short = source_file.replace(ctdir, '', 1)
-            ext = re.findall(r'\.\w+$', fn)[0]
-            ext_conf = content_extensions[ext]
-            if ext_conf.get('is_binary'):
-                try:
-                    meta, doc = binary_to_markdown(
-                        source_file, ext_conf.get('pandoc_binary_format'), datadir[:-5])
-                except RuntimeError as e:
-                    print("ERROR: Could not convert {} using pandoc: {}".format(source_file, e))
-                    continue
-                for k in ext_conf:
-                    if not k in meta:
-                        meta[k] = ext_conf[k]
-            elif previewing and preview_content:
-                meta, doc = frontmatter.parse(preview_content)
-                meta = maybe_extra_meta(meta, source_file)
-                # TODO: handle possible pandoc metadata for non-Markdown formats?
-            else:
-                with open(source_file) as f:
-                    try:
-                        meta, doc = frontmatter.parse(f.read())
-                        meta = maybe_extra_meta(meta, source_file)
-                        # Integrate pandoc's understanding of metadata for
-                        # text-based non-markdown formats (other than textile,
-                        # which uses YAML frontmatter natively).
-                        # NOTE: Currently leads to the file being parsed twice --
-                        # but only on the first pass, since the result is cached
-                        # (regardless of the no_cache setting)
-                        if fn.endswith(pandoc_meta_exts):
-                            input_format = meta.get('pandoc_input_format', ext_conf['pandoc_input_format'])
-                            pmeta = pandoc_metadata(doc, source_file, input_format, datadir[:-5])
-                            for k in pmeta:
-                                if not k in meta:
-                                    meta[k] = pmeta[k]
-                    except Exception as e:
-                        raise Exception(
-                            "Error when parsing frontmatter for " + source_file + ': ' + str(e))
-            if meta.get('draft', False) and not conf.get('render_drafts', False):
+            sources.append((root, fn))
+    # Pandoc conversions (including binary formats and metadata for non-markdown
+    # formats) are run concurrently, but the results are used in the original
+    # order of the source files.
+    workers = int(conf.get('pandoc_workers', min(8, os.cpu_count() or 1)))
+    BackgroundJobs.configure(1 if previewing else workers)
+    executor = None if previewing or workers < 2 \
+        else concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    conf['_pandoc_executor'] = executor
+    prefetched = {}
+    if executor:
+        for root, fn in sources:
+            if fn.endswith(pandoc_meta_exts) or content_extensions[
+                    re.findall(r'\.\w+$', fn)[0]].get('is_binary'):
+                source_file = os.path.join(root, fn)
+                prefetched[source_file] = executor.submit(
+                    read_content_file, source_file, content_extensions,
+                    datadir, pandoc_meta_exts, conf)
+    for root, fn in sources:
+        source_file = os.path.join(root, fn)
+        source_file_short = source_file.replace(ctdir, '', 1)
+        if previewing and preview_content:
+            meta, doc = frontmatter.parse(preview_content)
+            meta = maybe_extra_meta(meta, source_file)
+            # TODO: handle possible pandoc metadata for non-Markdown formats?
+        else:
+            try:
+                if source_file in prefetched:
+                    meta, doc = prefetched[source_file].result()
+                else:
+                    meta, doc = read_content_file(
+                        source_file, content_extensions, datadir,
+                        pandoc_meta_exts, conf)
+            except RuntimeError as e:
+                print("ERROR: Could not convert {} using pandoc: {}".format(source_file, e))
                 continue
-            process_content_item(
-                meta, doc, content, conf, template_vars,
-                ctdir, outputdir, datadir, content_extensions, known_ids,
-                root, fn, source_file, source_file_short, extpat,
-                previewing)
+        if meta.get('draft', False) and not conf.get('render_drafts', False):
+            continue
+        process_content_item(
+            meta, doc, content, conf, template_vars,
+            ctdir, outputdir, datadir, content_extensions, known_ids,
+            root, fn, source_file, source_file_short, extpat,
+            previewing)
+    if executor:
+        for ct in content:
+            if isinstance(ct['rendered'], concurrent.futures.Future):
+                ct['rendered'] = ct['rendered'].result()
+                pg = ct['data']['page']
+                if not pg.summary and pg.generate_summary:
+                    generate_summary(ct)
+        executor.shutdown()
+    conf.pop('_pandoc_executor', None)
     if previewing:
         return content[0]
     get_extra_content(
@@ -1433,11 +1968,55 @@ def get_content(ctdir, datadir, outputdir, template_vars, conf,
     # We must call this before adding MDCONTENT to each item below
     # (since that will create circular references):
     maybe_save_mdcontent_as_json(content, conf, os.path.split(ctdir)[0])
+    maybe_save_content_db(content, conf, os.path.split(ctdir)[0])
+    collections = get_collections(content, conf)
+    template_vars['COLLECTIONS'] = collections
     for it in content:
         it['data']['MDCONTENT'] = content
+        it['data']['COLLECTIONS'] = collections
     return content
 
 
+@hookable
+def read_content_file(source_file, content_extensions, datadir,
+                      pandoc_meta_exts, conf=None):
+    """
+    Returns the metadata and body of a content file (as a tuple), converting it
+    to markdown first if it is in a binary format. May raise RuntimeError if a
+    pandoc conversion fails.
+    """
+    ext = re.findall(r'\.\w+$', source_file)[0]
+    ext_conf = content_extensions[ext]
+    if ext_conf.get('is_binary'):
+        meta, doc = binary_to_markdown(
+            source_file, ext_conf.get('pandoc_binary_format'), datadir[:-5])
+        for k in ext_conf:
+            if not k in meta:
+                meta[k] = ext_conf[k]
+        return (meta, doc)
+    with open(source_file) as f:
+        try:
+            meta, doc = frontmatter.parse(f.read())
+            meta = maybe_extra_meta(meta, source_file)
+            # Integrate pandoc's understanding of metadata for
+            # text-based non-markdown formats (other than textile,
+            # which uses YAML frontmatter natively).
+            # NOTE: Currently leads to the file being parsed twice --
+            # but only on the first pass, since the result is cached
+            # (regardless of the no_cache setting)
+            if source_file.endswith(pandoc_meta_exts):
+                input_format = meta.get('pandoc_input_format', ext_conf['pandoc_input_format'])
+                pmeta = pandoc_metadata(
+                    doc, source_file, input_format, datadir[:-5], conf, meta)
+                for k in pmeta:
+                    if not k in meta:
+                        meta[k] = pmeta[k]
+        except Exception as e:
+            raise Exception(
+                "Error when parsing frontmatter for " + source_file + ': ' + str(e))
+    return (meta, doc)
+
+
 @hookable
 def get_extra_content(
         content, ctdir=None, datadir=None, outputdir=None,
@@ -1616,7 +2195,19 @@ def process_content_item(
         'doc': doc,
         'url': data['SELF_URL'],
     })
-    content[-1]['rendered'] = render_markdown(content[-1], conf)
+    is_pandoc = data['page'].get('pandoc', conf.get('pandoc', False)) \
+        and not data['page'].get('_is_html', source_file.endswith('.html'))
+    executor = conf.get('_pandoc_executor')
+    if executor and is_pandoc:
+        # A Future, which is resolved in get_content()
+        content[-1]['rendered'] = executor.submit(
+            render_markdown_exclusively, content[-1], conf)
+        return
+    elif executor:
+        # Pandoc pages may be rendered by other threads at the same time
+        content[-1]['rendered'] = render_markdown_exclusively(content[-1], conf)
+    else:
+        content[-1]['rendered'] = render_markdown(content[-1], conf)
     if not data['page'].summary and data['page'].generate_summary:
         generate_summary(content[-1])
 
@@ -1807,6 +2398,130 @@ def write_redir_file(from_path, redir_to, webroot):
     print("REDIR: {} => {}".format(from_path, redir_to))
 
 
+@hookable
+def prune_render_cache(conf, basedir, max_age=None, max_size=None, vacuum=None):
+    """
+    Evict old or least recently used entries from the render cache according
+    to `cache_max_age` (in days) and `cache_max_size` (e.g. '500M' or '2G')
+    in the configuration, unless overridden by the `max_age` and `max_size`
+    parameters. Returns the number of removed entries.
+    """
+    configure_render_cache(conf, basedir)
+    if max_age is None:
+        max_age = conf.get('cache_max_age')
+    max_size = parse_size(max_size if max_size else conf.get('cache_max_size'))
+    if not (max_age or max_size):
+        return 0
+    removed = RenderCache.prune(
+        basedir, max_age=max_age, max_size=max_size, vacuum=vacuum)
+    if removed:
+        print('[%s] - render cache: pruned %d entries' % (
+            str(datetime.datetime.now()), removed))
+    return removed
+
+
+def configure_render_cache(conf, basedir):
+    """
+    Apply the render cache settings in the configuration. The environment
+    variables WMK_RENDER_CACHE_DIR and WMK_RENDER_CACHE_READONLY take
+    precedence over `render_cache_dir` and `render_cache_readonly`.
+    """
+    cache_dir = os.environ.get(
+        'WMK_RENDER_CACHE_DIR', conf.get('render_cache_dir')) or ''
+    if cache_dir:
+        cache_dir = os.path.join(basedir, os.path.expanduser(cache_dir))
+    readonly = os.environ.get('WMK_RENDER_CACHE_READONLY')
+    if readonly is None:
+        readonly = conf.get('render_cache_readonly', False)
+    elif readonly.lower() in ('', '0', 'false', 'no', 'off'):
+        readonly = False
+    RenderCache.configure(
+        compression=conf.get('cache_compression', 'auto'),
+        directory=cache_dir, readonly=bool(readonly))
+
+
+def cache_command(basedir, action, args=None):
+    """
+    Handles `wmk cache stats`, `wmk cache clear` (and `wmk clear-cache`) and
+    `wmk cache prune [--max-age DAYS] [--max-size SIZE]`.
+    """
+    basedir = os.path.realpath(basedir)
+    args = list(args or [])
+    conf_file = re.sub(
+        r'.*/', '', os.environ.get('WMK_CONFIG', '')) or 'wmk_config.yaml'
+    conf = get_config(basedir, conf_file)
+    configure_render_cache(conf, basedir)
+    if action == 'stats':
+        st = RenderCache.stats(basedir)
+        fmt_ts = lambda x: str(datetime.datetime.fromtimestamp(x)) if x else '-'
+        print('RENDER CACHE:')
+        print('  - %s: %s' % (
+            'directory' if RenderCache.directory else 'file', st['filename']))
+        print('  - file size: %s' % format_size(st['file_size']))
+        print('  - entries: %d' % st['entries'])
+        print('  - cached data: %s' % format_size(st['data_size']))
+        print('  - oldest entry: %s' % fmt_ts(st['oldest']))
+        print('  - newest entry: %s' % fmt_ts(st['newest']))
+        print('  - least recently used: %s' % fmt_ts(st['least_recent']))
+        print('  - limits: max_age=%s, max_size=%s' % (
+            conf.get('cache_max_age', '-'), conf.get('cache_max_size', '-')))
+    elif action == 'prune':
+        max_age = max_size = None
+        while args:
+            opt = args.pop(0)
+            if opt == '--max-age' and args:
+                max_age = float(args.pop(0))
+            elif opt == '--max-size' and args:
+                max_size = args.pop(0)
+        if not (max_age or max_size or conf.get('cache_max_age')
+                or conf.get('cache_max_size')):
+            print('Nothing to do: set cache_max_age and/or cache_max_size in '
+                  'the config file or use --max-age/--max-size')
+            return
+        before = RenderCache.stats(basedir)
+        removed = prune_render_cache(conf, basedir, max_age, max_size, vacuum=True)
+        after = RenderCache.stats(basedir)
+        print('Removed %d of %d cache entries; file size %s => %s' % (
+            removed, before['entries'],
+            format_size(before['file_size']), format_size(after['file_size'])))
+    elif action == 'clear':
+        if RenderCache.readonly:
+            print('The render cache is read-only; nothing removed')
+        elif RenderCache.directory:
+            removed = RenderCache.clear(basedir)
+            print('Removed %d entries from the cache directory (%s)' % (
+                removed, RenderCache.directory))
+        elif os.path.exists(RenderCache.cache_filename(basedir)):
+            print('Removing cache file (%s)' % RenderCache.cache_filename(basedir))
+            RenderCache.clear(basedir)
+        else:
+            print('No cache file found')
+    else:
+        print('ERROR: unknown cache action: %s' % action)
+        sys.exit(1)
+
+
+def parse_size(val):
+    "Size in bytes from a number of megabytes or a string such as '500M'."
+    if not val:
+        return None
+    if isinstance(val, (int, float)):
+        return int(val * 1024 * 1024)
+    found = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)b?\s*$', str(val), flags=re.I)
+    if not found:
+        raise ValueError('Invalid size: %s' % val)
+    num, unit = found.groups()
+    mult = {'': 1024**2, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+    return int(float(num) * mult[unit.lower()])
+
+
+def format_size(num):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (num, unit)
+        num /= 1024
+
+
 def maybe_mkdir(fn):
     dirname = os.path.dirname(fn)
     if not os.path.isdir(dirname):
@@ -1852,7 +2567,16 @@ def get_newest_ts_of_dir(src):
 
 
 def parse_argstr(argstr):
-    "Parse a string representing the arguments part of a function call."
+    """
+    Parse a string representing the arguments part of a function call.
+    Results are memoized; the caller gets its own copy.
+    """
+    args, kwargs = _parse_argstr(argstr)
+    return copy.deepcopy(args), copy.deepcopy(kwargs)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_argstr(argstr):
     try:
         fake = 'f({})'.format(argstr)
         tree = ast.parse(fake)
@@ -1864,6 +2588,40 @@ def parse_argstr(argstr):
         raise Exception("Could not parse argstr: {}".format(argstr))
 
 
+# funcname, argstr
+SHORTCODE_PAT = re.compile(
+    r'{{<[ \n\r\t]*(\w+)\(\s*(.*?)\s*\)\s*>}}', flags=re.DOTALL)
+SHORTCODE_INCLUDE_PAT = re.compile(
+    r'{{<[ \n\r\t]*(include)\(\s*(.*?)\s*\)\s*>}}', flags=re.DOTALL)
+# Limit for shortcodes whose output contains further shortcodes
+SHORTCODE_MAX_DEPTH = 20
+
+
+def expand_shortcodes(doc, replacer, pat=SHORTCODE_PAT, source=None, depth=0):
+    """
+    Replaces the shortcodes matching `pat` in a single pass through `doc`. The
+    output of each shortcode is expanded in the same way (recursively, up to
+    SHORTCODE_MAX_DEPTH levels) before being put in its place.
+    """
+    if '{{<' not in doc:
+        return doc
+    ret = []
+    pos = 0
+    for match in pat.finditer(doc):
+        ret.append(doc[pos:match.start()])
+        output = replacer(match)
+        if '{{<' in output and pat.search(output):
+            if depth < SHORTCODE_MAX_DEPTH:
+                output = expand_shortcodes(output, replacer, pat, source, depth+1)
+            else:
+                print("WARNING: shortcodes nested too deeply in {}".format(
+                    source or '??'))
+        ret.append(output)
+        pos = match.end()
+    ret.append(doc[pos:])
+    return ''.join(ret)
+
+
 @hookable
 def handle_shortcode(conf, ctx, nth=None):
     "Return a match replacement function for shortcode handling."
@@ -1885,6 +2643,19 @@ def handle_shortcode(conf, ctx, nth=None):
             ext = 'jc' if is_jinja else 'mc'
             tplnam = '%s/%s.%s' % (subdir.strip('/'), name, ext)
             tpl = lookup.get_template(tplnam)
+            pg = ctx.get('page')
+            if isinstance(pg, dict):
+                add_page_dependency(pg, getattr(tpl, 'filename', None))
+                pp_count = len(pg.get('POSTPROCESS') or [])
+                prev_deps = list(pg.get('DEPENDENCIES') or [])
+            memo = shortcode_memo(tpl, tplnam, args, kwargs, conf, ctx)
+            if memo:
+                found = memo.get()
+                if found is not None:
+                    if isinstance(pg, dict):
+                        for fn in found[1]:
+                            add_page_dependency(pg, fn)
+                    return found[0]
             ckwargs = {}
             ckwargs.update(ctx)
             ckwargs.update(kwargs)
@@ -1896,9 +2667,22 @@ def handle_shortcode(conf, ctx, nth=None):
                 if args:
                     raise Exception(
                         'Cannot handle positional shortcode arguments with jinja_templates set to True')
-                return tpl.render(**ckwargs)
+                output = tpl.render(**ckwargs)
             else:
-                return tpl.render(*args, **ckwargs)
+                output = tpl.render(*args, **ckwargs)
+            if isinstance(pg, dict) and len(pg.get('POSTPROCESS') or []) > pp_count:
+                # Remember the call, so that the POSTPROCESS action can be
+                # recreated if the page is retrieved from the cache.
+                if not pg.get('_POSTPROCESS_CALLS'):
+                    pg['_POSTPROCESS_CALLS'] = []
+                pg['_POSTPROCESS_CALLS'].append((name, argstr, nth[name]))
+            elif memo:
+                added = []
+                if isinstance(pg, dict):
+                    added = [_ for _ in (pg.get('DEPENDENCIES') or [])
+                             if _ not in prev_deps]
+                memo.put(output, added)
+            return output
         except Exception as e:
             print("WARNING: shortcode {} failed in {}: {}".format(
                 name, ctx.get('SELF_SHORT_PATH', '??'), e))
@@ -1907,6 +2691,94 @@ def handle_shortcode(conf, ctx, nth=None):
     return replacer
 
 
+class ShortcodeMemo:
+    """
+    Cached output of a shortcode call, for shortcodes whose templates declare
+    themselves pure, i.e. their output depends only on the arguments of the
+    call. The memo lasts for the current build, or is kept in the RenderCache
+    if `persistent` is true.
+    """
+
+    def __init__(self, key, store, cache=None):
+        self.key = key
+        self.store = store
+        self.cache = cache
+
+    def get(self):
+        "Returns (output, dependencies) or None."
+        if self.key in self.store:
+            return self.store[self.key]
+        if self.cache is None:
+            return None
+        found = self.cache.get_cache()
+        if found is None:
+            return None
+        deps = [self.cache.full_path(_)
+                for _ in (self.cache.meta.get('page_deps') or [])]
+        self.store[self.key] = (found, deps)
+        return self.store[self.key]
+
+    def put(self, output, deps):
+        self.store[self.key] = (output, deps)
+        if self.cache is not None:
+            self.cache.write_cache(output, {
+                'deps': deps,
+                'page_deps': [self.cache.portable_path(_) for _ in deps]})
+
+
+def shortcode_memo(tpl, tplnam, args, kwargs, conf, ctx):
+    """
+    Returns a ShortcodeMemo for the call if the shortcode template declares
+    itself cacheable, otherwise None. In a Mako shortcode this is done with
+    `<%! cacheable = True %>`, in a Jinja2 shortcode with
+    `{% set cacheable = true %}`. The value 'persistent' instead of True means
+    that the output may be kept in the render cache between builds.
+    """
+    modes = conf.setdefault('_shortcode_cache_modes', {})
+    fn = getattr(tpl, 'filename', None) or tplnam
+    if fn not in modes:
+        modes[fn] = shortcode_cache_mode(tpl)
+    mode = modes[fn]
+    if not mode:
+        return None
+    try:
+        key = json.dumps([tplnam, args, kwargs], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    store = conf.setdefault('_shortcode_memo', {})
+    cache = None
+    datadir = ctx.get('DATADIR')
+    if mode == 'persistent' and datadir and conf.get('use_cache', True) \
+            and getattr(tpl, 'filename', None):
+        cache = RenderCache(
+            key, str(['shortcode', file_hash(tpl.filename)]), datadir[:-5])
+    return ShortcodeMemo(key, store, cache)
+
+
+def shortcode_cache_mode(tpl):
+    "Returns 'build', 'persistent' or None, depending on `cacheable`."
+    if hasattr(tpl, 'code'):
+        # Mako
+        val = getattr(tpl.module, 'cacheable', None)
+    else:
+        from jinja2 import nodes
+        env = tpl.environment
+        try:
+            source = env.loader.get_source(env, tpl.name)[0]
+        except Exception:
+            return None
+        val = None
+        for node in env.parse(source).body:
+            if isinstance(node, nodes.Assign) \
+                    and isinstance(node.target, nodes.Name) \
+                    and node.target.name == 'cacheable' \
+                    and isinstance(node.node, nodes.Const):
+                val = node.node.value
+    if val == 'persistent':
+        return val
+    return 'build' if val else None
+
+
 def _fix_jinja_shortcode_args(name, args, ckwargs):
     # Workaround to allow using positional arguments for "built-in" shortcodes
     # when Jinja2 templates are being used.
@@ -1951,6 +2823,105 @@ def maybe_save_mdcontent_as_json(content, conf, basedir):
         print("WARNING: Invalid config value for mdcontent_json: '%s'" % full_dump)
 
 
+@hookable
+def maybe_save_content_db(content, conf, basedir):
+    """
+    Updates the SQLite file specified by the `content_db` setting (if any) so
+    that it reflects the current content, writing only changed rows.
+    """
+    db_file = conf.get('content_db', None)
+    if db_file is True:
+        db_file = 'tmp/content.sqlite'
+    if db_file and isinstance(db_file, str) and db_file.endswith(
+            ('.sqlite', '.sqlite3', '.db')):
+        # Same restrictions as for mdcontent_json, but tmp is the default
+        while db_file.startswith(('.', '/')):
+            db_file = db_file.strip('/')
+            db_file = db_file.strip('.')
+        if not db_file.startswith(('data/', 'tmp/', 'htdocs/')):
+            db_file = os.path.join('tmp', db_file)
+        db = PersistentContentDB(os.path.join(basedir, db_file))
+        changed, removed = db.update(content)
+        db.close()
+        if changed or removed:
+            print('[%s] - content db: %d changed, %d removed' % (
+                str(datetime.datetime.now()), changed, removed))
+    elif db_file:
+        print("WARNING: Invalid config value for content_db: '%s'" % db_file)
+
+
+# Front matter keys for the taxonomy names in collection definitions
+COLLECTION_TAXONOMY_KEYS = {
+    'tag': ['tag', 'tags'],
+    'tags': ['tag', 'tags'],
+    'category': ['category', 'categories'],
+    'categories': ['category', 'categories'],
+    'section': ['section', 'sections'],
+    'sections': ['section', 'sections'],
+    'author': ['author', 'authors'],
+    'authors': ['author', 'authors'],
+}
+
+
+@hookable
+def get_collections(content, conf):
+    """
+    Builds the named subsets of the content declared in the `collections`
+    setting, which become the COLLECTIONS template variable. Each collection
+    is defined by a dict whose conditions must all match:
+
+    - `path`: glob pattern(s) for `source_file_short`, e.g. `recipes/*`;
+    - `type`: value(s) of the `type` front matter field;
+    - `is_post`: true for blog posts only, false for non-posts only;
+    - `taxonomy`: a dict of taxonomy names (e.g. `tags`, `section`) and values;
+    - `match`: a `page_match()` expression;
+    - `where` (and optionally `bind`): an SQL where clause for
+      `page_match_sql()`.
+
+    In addition, `ordering` and `limit` work like in `page_match()`, while
+    `group_by` turns the collection into a dict of lists (see the `group_by()`
+    method of MDContentList) keyed on the given front matter field.
+    """
+    ret = attrdict({})
+    defs = conf.get('collections') or {}
+    if not isinstance(defs, dict):
+        print("WARNING: Invalid config value for collections (must be a dict)")
+        return ret
+    for name, spec in defs.items():
+        if not isinstance(spec, dict):
+            print("WARNING: Invalid definition of collection '%s'" % name)
+            continue
+        found = content
+        if spec.get('match'):
+            found = found.page_match(spec['match'])
+        if spec.get('path'):
+            globs = spec['path'] if isinstance(spec['path'], list) else [spec['path']]
+            found = found.match_entry(
+                lambda x: any([fnmatch.fnmatchcase(
+                    x['source_file_short'].strip('/'), _.strip('/'))
+                               for _ in globs]))
+        if spec.get('type'):
+            types = spec['type'] if isinstance(spec['type'], list) else [spec['type']]
+            found = found.match_page(lambda x: x.get('type') in types)
+        if 'is_post' in spec:
+            found = found.posts(ordered=False) if spec['is_post'] \
+                else found.non_posts()
+        for txy, needles in (spec.get('taxonomy') or {}).items():
+            found = found.has_taxonomy(
+                COLLECTION_TAXONOMY_KEYS.get(txy, [txy]), needles)
+        if spec.get('where'):
+            found = found.page_match_sql(spec['where'], bind=spec.get('bind'))
+        found = found.ordered_and_limited(spec.get('ordering'), spec.get('limit'))
+        if spec.get('group_by'):
+            # NOTE: attrdict(dict) would convert the items of the lists
+            groups = attrdict({})
+            for k, v in found.group_by(spec['group_by']).items():
+                groups[k] = v
+            found = groups
+        ret[name] = found
+    return ret
+
+
 @hookable
 def build_lunr_index(content, index_fields, langs=None):
     """
@@ -2046,7 +3017,9 @@ if __name__ == '__main__':
     basedir = sys.argv[1] if len(sys.argv) > 1 else None
     quick = True if len(sys.argv) > 2 and sys.argv[2] in ('-q', '--quick') else False
     preview = sys.argv[3] if len(sys.argv) > 3 and sys.argv[2] == '--preview' else None
-    if preview:
+    if len(sys.argv) > 3 and sys.argv[2] == '--cache':
+        cache_command(basedir, sys.argv[3], sys.argv[4:])
+    elif preview:
         print(preview_single(basedir, preview))
     else:
         main(basedir, quick)
@@ -7,9 +7,7 @@ import shutil
 import json
 from email.utils import formatdate  # rfc822
 
-import markdown
-
-from wmk_utils import slugify
+from wmk_utils import slugify, markdown_to_html
 
 
 __all__ = [
@@ -172,7 +170,7 @@ def markdownify(s=None, extensions=None):
     if extensions is None:
         extensions = ['extra']
     def inner(s):
-        return markdown.markdown(s, extensions=extensions)
+        return markdown_to_html(s, extensions=extensions)
     return inner if s is None else inner(s)
 
 
@@ -6,15 +6,50 @@ import sqlite3
 import hashlib
 import json
 import locale
+import time
+import tempfile
+import threading
+import zlib
+import atexit
+import functools
+import concurrent.futures
+import base64
+import bisect
+import heapq
+import socket
+import subprocess
+import urllib.request
+from collections import OrderedDict
+from html import unescape
+
+import markdown
 from mako.exceptions import TemplateLookupException
 
 
+_slugs = {}
+
 def slugify(s):
     """
     Make a 'slug' from the given string. If it seems to end with a file
     extension, remove that first and re-append a lower case version of it before
     returning the result. Probably only works for Latin text.
+    Results are memoized.
     """
+    memo_key = (type(s), s)
+    try:
+        return _slugs[memo_key]
+    except KeyError:
+        pass
+    except TypeError:
+        # unhashable
+        return _slugify(s)
+    if len(_slugs) > 100000:
+        _slugs.clear()
+    _slugs[memo_key] = _slugify(s)
+    return _slugs[memo_key]
+
+
+def _slugify(s):
     if not isinstance(s, str):
         # print("WARNING: NOT A STRING: ", s)
         s = str(s)
@@ -75,6 +110,195 @@ def dartsass_compile(
     os.system(cmd)
 
 
+_markdown_pool = threading.local()
+
+MARKDOWN_ENGINES = {
+    'python-markdown': 'markdown',
+    'markdown-it': 'markdown_it',
+    'mistune': 'mistune',
+}
+_markdown_engine_aliases = {
+    'markdown': 'python-markdown',
+    'python_markdown': 'python-markdown',
+    'markdown-it-py': 'markdown-it',
+    'markdown_it': 'markdown-it',
+}
+_markdown_engine_warnings = set()
+
+def markdown_engine_name(engine=None):
+    """
+    The canonical name of the given markdown engine (python-markdown by default).
+    Falls back to python-markdown (with a warning) if the engine is unknown or
+    its module is not installed.
+    """
+    if not engine:
+        return 'python-markdown'
+    engine = str(engine).lower()
+    engine = _markdown_engine_aliases.get(engine, engine)
+    if engine == 'python-markdown':
+        return engine
+    problem = None
+    if engine not in MARKDOWN_ENGINES:
+        problem = 'unknown'
+    else:
+        try:
+            __import__(MARKDOWN_ENGINES[engine])
+        except ImportError:
+            problem = 'not installed'
+    if problem:
+        if engine not in _markdown_engine_warnings:
+            print("WARNING: markdown engine %s %s; using python-markdown"
+                  % (engine, problem))
+            _markdown_engine_warnings.add(engine)
+        return 'python-markdown'
+    return engine
+
+
+def markdown_to_html(doc, extensions=None, extension_configs=None, engine=None):
+    """
+    Same as `markdown.markdown()`, except that the Markdown instance (with its
+    extensions loaded and configured) is kept in a pool keyed on the settings
+    and reused for later documents, rather than being created anew each time.
+    Each thread has its own pool.
+
+    If `engine` is 'markdown-it' or 'mistune' (and the corresponding module is
+    installed), that engine is used instead of Python-Markdown. See
+    `_markdown_alt_engine()` for which extensions are supported in that case.
+    """
+    extensions = list(extensions or [])
+    extension_configs = extension_configs or {}
+    engine = markdown_engine_name(engine)
+    if engine != 'python-markdown':
+        return _markdown_alt_engine(doc, extensions, extension_configs, engine)
+    if not all([isinstance(_, str) for _ in extensions]):
+        # Extension instances may carry state between documents
+        return markdown.markdown(
+            doc, extensions=extensions, extension_configs=extension_configs)
+    key = json.dumps(
+        [extensions, extension_configs], sort_keys=True, default=repr)
+    pool = getattr(_markdown_pool, 'converters', None)
+    if pool is None:
+        pool = _markdown_pool.converters = {}
+    free = pool.setdefault(key, [])
+    # Normally there is only one instance per key, but a conversion may be
+    # triggered while another one is in progress (e.g. by an extension).
+    md = free.pop() if free else markdown.Markdown(
+        extensions=extensions, extension_configs=extension_configs)
+    try:
+        return md.reset().convert(doc)
+    finally:
+        free.append(md)
+
+
+def _markdown_alt_engine(doc, extensions, extension_configs, engine):
+    """
+    Convert markdown using markdown-it-py or mistune, approximating the
+    behaviour of the following Python-Markdown extensions if they are active:
+
+    - `extra`: tables, footnotes and definition lists (with mdit-py-plugins for
+      the latter two if the engine is markdown-it);
+    - `tables`, `footnotes` and `def_list` individually;
+    - `toc`: heading ids and `[TOC]` (including the `toc_depth` setting);
+    - `wikilinks` (including the `base_url`, `end_url` and `html_class`
+      settings).
+
+    Other extensions are ignored. Raw HTML (e.g. the output of shortcodes)
+    is passed through as is.
+    """
+    wanted = lambda x: x in extensions or ('extra' in extensions and x != 'toc')
+    pool = getattr(_markdown_pool, 'converters', None)
+    if pool is None:
+        pool = _markdown_pool.converters = {}
+    features = tuple([_ for _ in ('tables', 'footnotes', 'def_list') if wanted(_)])
+    key = (engine, features)
+    if key not in pool:
+        if engine == 'markdown-it':
+            from markdown_it import MarkdownIt
+            md = MarkdownIt('commonmark', {'html': True})
+            if 'tables' in features:
+                md.enable('table')
+            try:
+                if 'footnotes' in features:
+                    from mdit_py_plugins.footnote import footnote_plugin
+                    md.use(footnote_plugin)
+                if 'def_list' in features:
+                    from mdit_py_plugins.deflist import deflist_plugin
+                    md.use(deflist_plugin)
+            except ImportError:
+                pass
+            pool[key] = md.render
+        else:
+            import mistune
+            plugins = {'tables': 'table', 'footnotes': 'footnotes',
+                       'def_list': 'def_list'}
+            pool[key] = mistune.create_markdown(
+                escape=False, plugins=[plugins[_] for _ in features])
+    html = pool[key](doc)
+    if 'wikilinks' in extensions:
+        html = _markdown_wikilinks(html, extension_configs.get('wikilinks') or {})
+    if 'toc' in extensions:
+        html = _markdown_toc(html, extension_configs.get('toc') or {})
+    return html
+
+
+def _markdown_wikilinks(html, conf):
+    # Like the wikilinks extension, but outside of code blocks
+    base_url = conf.get('base_url', '/')
+    end_url = conf.get('end_url', '/')
+    html_class = conf.get('html_class', 'wikilink')
+    def link(match):
+        label = match.group(1).strip()
+        url = base_url + re.sub(r'([ ]+_)|(_[ ]+)|([ ]+)', '_', label) + end_url
+        cls = ' class="%s"' % html_class if html_class else ''
+        return '<a%s href="%s">%s</a>' % (cls, url, label)
+    parts = re.split(r'(<(pre|code)\b.*?</\2>)', html, flags=re.S)
+    ret = []
+    for i, part in enumerate(parts):
+        if i % 3 == 0:
+            part = re.sub(r'\[\[([\w0-9_ -]+)\]\]', link, part)
+        if i % 3 != 2:
+            ret.append(part)
+    return ''.join(ret)
+
+
+def _markdown_toc(html, conf):
+    # Heading ids and [TOC] like the toc extension of Python-Markdown
+    from markdown.extensions.toc import slugify as toc_slugify, unique
+    strip_tags = lambda x: re.sub(r'<[^>]+>', '', x)
+    separator = conf.get('separator', '-')
+    depth = str(conf.get('toc_depth', 6))
+    if '-' in depth:
+        top, bottom = [int(_) for _ in depth.split('-', 1)]
+    else:
+        top, bottom = 1, int(depth)
+    used_ids = set(re.findall(r'<[^>]+ id="([^"]+)"', html))
+    def add_id(match):
+        attrs = match.group(2)
+        if ' id="' in attrs:
+            return match.group(0)
+        text = unescape(strip_tags(match.group(3)))
+        hid = unique(toc_slugify(text, separator), used_ids)
+        return '<h%s%s id="%s">%s</h%s>' % (
+            match.group(1), attrs, hid, match.group(3), match.group(1))
+    html = re.sub(r'<h([1-6])([^>]*)>(.*?)</h\1>', add_id, html, flags=re.S)
+    if '[TOC]' not in html:
+        return html
+    def list_items(items):
+        ret = []
+        for it in items:
+            if top <= it.level <= bottom:
+                ret.append('<li><a href="%s">%s</a>%s</li>' % (
+                    it.url, strip_tags(it.title), render(it.children)))
+            elif it.level < top:
+                ret += list_items(it.children)
+        return ret
+    def render(items):
+        ret = list_items(items)
+        return '<ul>\n%s\n</ul>\n' % '\n'.join(ret) if ret else ''
+    toc_html = '<div class="toc">\n%s</div>\n' % render(Toc(html).items)
+    return re.sub(r'<p>\[TOC\]</p>\n?', lambda m: toc_html, html)
+
+
 class attrdict(dict):
     """
     Dict with the keys as attributes (or member variables), for nicer-looking
@@ -139,27 +363,96 @@ class attrdict(dict):
 class MDContentList(list):
     """
     Filterable MDCONTENT, for ease of list components.
+
+    Lookups by slug, id, url, path and taxonomy term use hash indexes which are
+    built on first use (see `_index()`) and discarded if the list is modified.
+    Lists derived from another list by filtering or sorting remember it, so
+    that they can use its indexes rather than building their own. The same goes
+    for sort keys and sorted views (see `_sorted()`).
     """
 
+    def _index(self, name, build):
+        """
+        The index called `name` for this list, created by calling `build` with
+        the list as argument if it does not exist yet.
+        """
+        indexes = self.__dict__.setdefault('_indexes', {})
+        if name not in indexes:
+            indexes[name] = build(self)
+        return indexes[name]
+
+    def _changed(self, added=None):
+        # Called before any modification of the list. If the modification
+        # consists of adding the items in `added` to the end of the list, the
+        # taxonomy aggregates are kept and updated.
+        indexes = self.__dict__.pop('_indexes', None)
+        self.__dict__.pop('_parent', None)
+        self.__dict__['_version'] = self.__dict__.get('_version', 0) + 1
+        if added is not None and indexes:
+            kept = dict([(k, v) for k, v in indexes.items()
+                         if isinstance(v, TaxonomyAggregate)])
+            for agg in kept.values():
+                for it in added:
+                    agg.add(it)
+            if kept:
+                self.__dict__['_indexes'] = kept
+
+    def _parent_list(self):
+        # The list this one was derived from, if it has not changed since
+        parent = self.__dict__.get('_parent')
+        if parent and parent[0].__dict__.get('_version', 0) == parent[1]:
+            return parent[0]
+        return None
+
+    def _derived(self, items):
+        "A new MDContentList consisting of some or all of the items in this one."
+        ret = MDContentList(items)
+        root = self._parent_list() or self
+        ret.__dict__['_parent'] = (root, root.__dict__.get('_version', 0))
+        return ret
+
+    def _lookup(self, name, build, keys):
+        """
+        Items whose entry in the index `name` (see `_index()`) is any of `keys`,
+        in the original order.
+        """
+        source = self
+        parent = self._parent_list()
+        if parent is not None and name in parent.__dict__.get('_indexes', {}) \
+                and name not in self.__dict__.get('_indexes', {}):
+            source = parent
+        index = source._index(name, build)
+        positions = set()
+        for k in keys:
+            try:
+                positions.update(index.get(k, ()))
+            except TypeError:
+                # unhashable
+                continue
+        if source is self:
+            return self._derived([self[i] for i in sorted(positions)])
+        wanted = set([id(source[i]) for i in positions])
+        return self._derived([_ for _ in self if id(_) in wanted])
+
     def match_entry(self, pred):
         """
         Filter by all available info: source_file, source_file_short, target,
         template, data (i.e. template_context), doc (markdown source),
         url, rendered (html fragment, i.e. CONTENT).
         """
-        return MDContentList([_ for _ in self if pred(_)])
+        return self._derived([_ for _ in self if pred(_)])
 
     def match_ctx(self, pred):
         "Filter by template context (page, site, MTIME, SELF_URL, etc.)"
-        return MDContentList([_ for _ in self if pred(_['data'])])
+        return self._derived([_ for _ in self if pred(_['data'])])
 
     def match_page(self, pred):
         "Filter by page variables"
-        return MDContentList([_ for _ in self if pred(_['data']['page'])])
+        return self._derived([_ for _ in self if pred(_['data']['page'])])
 
     def match_doc(self, pred):
         "Filter by Markdown body"
-        return MDContentList([_ for _ in self if pred(_['doc'])])
+        return self._derived([_ for _ in self if pred(_['doc'])])
 
     def group_by(self, pred, normalize=None, keep_empty=False):
         """
@@ -196,31 +489,82 @@ class MDContentList(list):
                     found[k] = MDContentList([it])
         return found
 
+    def _sort_keys(self, name, key):
+        """
+        A dict of the sort keys of the items in this list (by id), computed
+        by `key` and kept as the index `('sortkey', name)`. The keys of the
+        list this one was derived from are reused where available.
+        """
+        def build(items):
+            known = {}
+            parent = items._parent_list()
+            if parent is not None:
+                known = parent.__dict__.get('_indexes', {}).get(
+                    ('sortkey', name), {})
+            return dict([
+                (id(_), known[id(_)] if id(_) in known else key(_))
+                for _ in items])
+        return self._index(('sortkey', name), build)
+
+    def _sorted_view(self, name, key, reverse):
+        "This list sorted by `key` as a plain list, kept as an index."
+        def build(items):
+            keys = items._sort_keys(name, key)
+            return sorted(items, key=lambda x: keys[id(x)], reverse=reverse)
+        return self._index(('sorted', name, reverse), build)
+
+    def _positions(self):
+        # Position of each item by id, or None if some items occur twice
+        def build(items):
+            ret = dict([(id(_), i) for i, _ in enumerate(items)])
+            return ret if len(ret) == len(items) else None
+        return self._index('positions', build)
+
+    def _sorted(self, name, key, reverse=False):
+        """
+        A new MDContentList with the items of this one sorted by `key` (a
+        function of an item), which is identified by `name` for caching
+        purposes. Sort keys and sorted views are cached like indexes. A list
+        derived from a larger one filters the sorted view of the latter (which
+        gives the same result as long as the items are in the same relative
+        order in both lists), unless it is small enough that sorting it is
+        cheaper.
+        """
+        parent = self._parent_list()
+        if parent is not None and len(self) * 4 >= len(parent):
+            positions = parent._positions()
+            wanted = [id(_) for _ in self]
+            pos = [positions.get(_, -1) for _ in wanted] if positions else [-1]
+            if -1 not in pos and all(
+                    [pos[i] < pos[i+1] for i in range(len(pos) - 1)]):
+                try:
+                    view = parent._sorted_view(name, key, reverse)
+                except Exception:
+                    # e.g. incomparable keys in items not in this list
+                    view = None
+                if view is not None:
+                    wanted = set(wanted)
+                    return self._derived([_ for _ in view if id(_) in wanted])
+        return self._derived(self._sorted_view(name, key, reverse))
+
     def sorted_by(self, key, reverse=False, default_val=-1):
-        if isinstance(default_val, str):
-            k = lambda x: locale.strxfrm(
-                x['data']['page'].get(key, default_val))
-        else:
-            k = lambda x: x['data']['page'].get(key, default_val)
-        return MDContentList(sorted(self, key=k, reverse=reverse))
+        name, k = _page_sort_key(key, default_val)
+        try:
+            hash(name)
+        except TypeError:
+            return self._derived(sorted(self, key=k, reverse=reverse))
+        return self._sorted(name, k, reverse)
 
     def sorted_by_date(self, newest_first=True, date_key='DATE'):
-        k = lambda x: str(
-            x['data'][date_key]
-              if date_key in ('DATE', 'MTIME') \
-              else x['data']['page'].get(date_key, x['data']['DATE']))
-        return MDContentList(sorted(self, key=k, reverse=newest_first))
+        name, k = _date_sort_key(date_key)
+        return self._sorted(name, k, newest_first)
 
     def sorted_by_title(self, reverse=False):
         return self.sorted_by('title', reverse=reverse, default_val='ZZZ')
 
     def in_date_range(self, start, end, date_key='DATE'):
-        std = lambda ts: str(ts).replace(' ', 'T')  # standard ISO fmt
-        def found(x):
-            pg = x['page']
-            date = x[date_key] if date_key in ('DATE', 'MTIME') else pg.get(date_key, x['DATE'])
-            return std(start) <= std(date) <= std(end)
-        return self.match_ctx(found)
+        return self.match_ctx(
+            lambda x: _in_date_range(x, start, end, date_key))
 
     def posts(self, ordered=True):
         """
@@ -228,21 +572,16 @@ class MDContentList(list):
         (posts, blog) or having a 'type' attribute of 'post', 'blog',
         'blog-entry' or 'blog_entry'.
         """
-        is_post = lambda x: (x['source_file_short'].strip('/').startswith(('posts/', 'blog/'))
-                             or x['data']['page'].get('type', '') in (
-                                 'post', 'blog', 'blog-entry', 'blog_entry'))
-        ret = self.match_entry(is_post)
-        return ret.sorted_by_date() if ordered else ret
+        def build(items):
+            ret = items.match_entry(_is_post)
+            return list(ret.sorted_by_date() if ordered else ret)
+        return self._derived(self._index(('posts', bool(ordered)), build))
 
     def non_posts(self):
         """
         'Pages', i.e. all entries that are NOT posts/blog entreis.
         """
-        not_post = lambda x: not (
-            x['source_file_short'].strip('/').startswith(('posts/', 'blog/'))
-            or x['data']['page'].get('type', '') in (
-                'post', 'blog', 'blog-entry', 'blog_entry'))
-        return self.match_entry(not_post)
+        return self.match_entry(lambda x: not _is_post(x))
 
     def has_slug(self, sluglist):
         """
@@ -250,8 +589,9 @@ class MDContentList(list):
         """
         if isinstance(sluglist, str):
             sluglist = (sluglist, )
-        slugpred = lambda x: x.slug in sluglist
-        return self.match_page(slugpred)
+        return self._lookup(
+            'slug', _field_index(lambda x: x['data']['page'].get('slug')),
+            sluglist)
 
     def has_id(self, idlist):
         """
@@ -259,14 +599,32 @@ class MDContentList(list):
         """
         if isinstance(idlist, str):
             idlist = (idlist, )
-        idpred = lambda x: x['id'] in idlist
-        return self.match_page(idpred)
+        return self._lookup(
+            'id', _field_index(lambda x: x['data']['page'].get('id')), idlist)
 
     def url_match(self, url_pred):
-        return self.match_entry(lambda x: urlpred(x['url']))
+        """
+        Pages whose URL satisfies `url_pred`, which is either a callable or
+        a URL (or list of URLs) which must match exactly.
+        """
+        if callable(url_pred):
+            return self.match_entry(lambda x: url_pred(x['url']))
+        if isinstance(url_pred, str):
+            url_pred = (url_pred, )
+        return self._lookup(
+            'url', _field_index(lambda x: x.get('url')), url_pred)
 
     def path_match(self, src_pred):
-        return self.match_entry(lambda x: src_pred(x['source_file_short']))
+        """
+        Pages whose `source_file_short` satisfies `src_pred`, which is either a
+        callable or a path (or list of paths) which must match exactly.
+        """
+        if callable(src_pred):
+            return self.match_entry(lambda x: src_pred(x['source_file_short']))
+        if isinstance(src_pred, str):
+            src_pred = (src_pred, )
+        return self._lookup(
+            'path', _field_index(lambda x: x.get('source_file_short')), src_pred)
 
     def get_content_taxonomies(self):
         """
@@ -331,6 +689,9 @@ class MDContentList(list):
                 'taxon': ['author', 'authors'],
             },
         ]
+        memo = self.__dict__.get('_indexes', {}).get('used_taxonomies')
+        if memo is not None:
+            return [dict(_) for _ in memo]
         found = self.get_content_taxonomies() or []
         known = set()
         for it in found:
@@ -353,7 +714,8 @@ class MDContentList(list):
                 if is_present and not is_known:
                     found.append(std)
                     known.add(tuple(std['taxon']))
-        return found
+        self._index('used_taxonomies', lambda x: found)
+        return [dict(_) for _ in found]
 
     def has_taxonomy(self, haystack_keys, needles):
         """
@@ -361,27 +723,18 @@ class MDContentList(list):
         characterized by `haystack_keys` (.e.g `['tag', 'tags']`).
         """
         if not needles:
-            return MDContentList([])
+            return self._derived([])
         if not isinstance(needles, (list, tuple)):
             needles = [needles]
         is_bool = len(needles) == 1 and isinstance(needles[0], bool) and needles[0]
-        if not is_bool:
+        if is_bool:
+            # at least one tag/category/etc. is present
+            needles = [True]
+        else:
             needles = [_.lower() for _ in needles]
-        def found(x):
-            for k in haystack_keys:
-                if k in x:
-                    if is_bool and x[k]:
-                        return True  ## at least one tag/category/etc. is present
-                    if isinstance(x[k], (list, tuple)):
-                        for _ in x[k]:
-                            if not _:
-                                continue
-                            if _.lower() in needles:
-                                return True
-                    elif x[k] and x[k].lower() in needles:
-                        return True
-            return False
-        return self.match_page(found)
+        haystack_keys = tuple(haystack_keys)
+        return self._lookup(
+            ('taxonomy', haystack_keys), _taxonomy_index(haystack_keys), needles)
 
     def taxonomy_info(self, keys, order='count', tostring=None):
         """
@@ -404,55 +757,22 @@ class MDContentList(list):
             keys = [keys]
         if not keys:
             return []
-        taxons = {}
-        slug2name = {}
-        seen_urls = set()
-        def _additem(tx, item):
-            seen_key = ':'.join([slugify(tx), item['url']])
-            if tx in taxons:
-                taxons[tx]['count'] += 1
-                if not item['url'] in seen_urls:
-                    taxons[tx]['items'].append(item)
-                    seen_urls.add(seen_key)
-            else:
-                slug = slugify(tx)
-                if slug in slug2name:
-                    taxons[slug2name[slug]]['count'] += 1
-                    if not seen_key in seen_urls:
-                        taxons[slug2name[slug]]['items'].append(item)
-                        seen_urls.add(seen_key)
-                    if not tx in taxons[slug2name[slug]]['forms']:
-                        taxons[slug2name[slug]]['forms'].append(tx)
-                else:
-                    taxons[tx] = {
-                        'name': tx,
-                        'slug': slug,
-                        'forms': [tx],
-                        'count': 1,
-                        'items': MDContentList([item]),
-                    }
-                    seen_urls.add(seen_key)
-                    slug2name[slug] = tx
-        for it in self:
-            pg = it['data']['page']
-            for k in keys:
-                if k in pg:
-                    if isinstance(pg[k], (str, int)):
-                        _additem(pg[k], it)
-                    elif isinstance(pg[k], (list, tuple)):
-                        for tx in pg[k]:
-                            if tostring and not isinstance(tx, (str, int)):
-                                _additem(tostring(tx), it)
-                            else:
-                                _additem(tx, it)
-                    elif tostring:
-                        _additem(tostring(pg[k]), it)
-        found = list(taxons.values())
-        if order == 'count':
-            found.sort(key=lambda x: x['count'], reverse=True)
-        elif order in ('name', 'slug'):
-            found.sort(key=lambda x: locale.strxfrm(x[order]), reverse=False)
-        return found
+        tostring_key = _callable_key(tostring)
+        name = ('taxonomy_info', tuple(keys), tostring_key)
+        def build(items):
+            # A list derived from another one can reuse the values found in
+            # the items of the latter.
+            parent = items._parent_list()
+            known = parent.__dict__.get('_indexes', {}).get(name) \
+                if parent is not None else None
+            agg = TaxonomyAggregate(tuple(keys), tostring)
+            for it in items:
+                agg.add(it, known.values_of(it) if known else None)
+            return agg
+        if tostring is not None and tostring_key is None:
+            # Not memoized, since we cannot tell whether it is the same function
+            return build(self).result(order, self)
+        return self._index(name, build).result(order, self)
 
     def get_categories(self, order='name'):
         "Categories along with list of pages/posts in them."
@@ -527,67 +847,28 @@ class MDContentList(list):
         front to indicate reverse ordering. The `limit`, if specified, indicates
         the maximum number of pages to return.
         """
-        found = MDContentList([])
-        known_conds = (
-            'title', 'slug', 'id', 'url', 'path', 'doc', 'date_range',
-            'has_attrs', 'attrs', 'has_tag', 'in_section', 'in_category',
-            'is_post', 'exclude_url')
-        boolval = lambda x: not bool(x) if inverse else bool(x)
+        try:
+            memo_key = json.dumps([match_expr, ordering, limit, inverse],
+                                  sort_keys=True, default=str)
+        except (TypeError, ValueError):
+            memo_key = None
+        memo = self._index('page_match', lambda x: {})
+        if memo_key is not None and memo_key in memo:
+            # A copy, so that the caller may modify it
+            return self._derived(memo[memo_key])
         if isinstance(match_expr, dict):
-            if not match_expr:
-                raise Exception('No condition for page_match')
-            for k in match_expr:
-                if not k in known_conds:
-                    raise Exception('Unknown condition for page_match: %s' % k)
+            plan = _page_match_plan(match_expr, inverse)
+            candidates = self
+            for method, arg in plan['narrow']:
+                candidates = getattr(candidates, method)(arg)
+            checks = plan['checks']
             def pred(c):
-                x = match_expr
                 p = c['data']['page']
-                if 'exclude_url' in x:
-                    # Normalize both URLs somewhat
-                    c_url = c['url'].replace('/index.html', '/')
-                    x_url = x['exclude_url'].replace('/index.html', '/')
-                    if c_url == x_url:
-                        return False
-                for k in ('title', 'slug'):
-                    if k in x and not boolval(re.search(x[k], p.get(k, ''), flags=re.I)):
-                        return False
-                if 'id' in x:
-                    idlist = (x['id'], ) if isinstance(x['id'], str) else x['id']
-                    if not boolval(p['id'] in idlist):
-                        return False
-                if 'url' in x and not boolval(re.search(x['url'], c['url'], flags=re.I)):
-                    return False
-                if 'path' in x and not boolval(re.search(x['path'], c['source_file_short'], flags=re.I)):
-                    return False
-                if 'doc' in x and not boolval(re.search(x['doc'], c['doc'], flags=re.I)):
-                    return False
-                if 'has_attrs' in x:
-                    for a in x['has_attrs']:
-                        if not boolval(p.get(a)):
-                            return False
-                if 'attrs' in x:
-                    for k in x['attrs']:
-                        if not boolval(str(p.get(k, '')).lower() == str(x['attrs'][k]).lower()):
-                            return False
-                if 'has_tag' in x:
-                    if not boolval(MDContentList([c]).has_tag(x['has_tag'])):
-                        return False
-                if 'in_section' in x:
-                    if not boolval(MDContentList([c]).in_section(x['in_section'])):
-                        return False
-                if 'in_category' in x:
-                    if not boolval(MDContentList([c]).in_category(x['in_category'])):
+                for check in checks:
+                    if not check(c, p):
                         return False
-                if 'is_post' in x:
-                    posts = MDContentList([c]).posts(ordered=False)
-                    if x['is_post'] and not boolval(posts):
-                        return False
-                    elif not x['is_post'] and boolval(posts):
-                        return False
-                if 'date_range' in x and not boolval(MDContentList([c]).in_date_range(*x['date_range'])):
-                    return False
                 return True
-            found = self.match_entry(pred)
+            found = candidates.match_entry(pred)
         elif isinstance(match_expr, (list, tuple)):
             accum = {}
             for exp in match_expr:
@@ -596,37 +877,78 @@ class MDContentList(list):
                     if it['url'] in accum:
                         continue
                     accum[it['url']] = it
-            found = MDContentList(list(accum.values()))
+            found = self._derived(list(accum.values()))
         else:
             raise Exception(
                 'page_match: the match_expr must be either a dict or a list of dicts')
+        found = found.ordered_and_limited(ordering, limit)
+        if memo_key is not None:
+            memo[memo_key] = list(found)
+        return found
+
+    def ordered_and_limited(self, ordering=None, limit=None):
+        """
+        Sort the list as specified by `ordering` (see `page_match()`) and
+        return at most `limit` items.
+        """
+        found = self
         if ordering and found:
-            # title,slug,url,date
-            reverse = False
-            if ordering[0] == '-':
-                reverse = True
-                ordering = ordering[1:]
-            if ordering in ('title', 'slug'):
-                found = found.sorted_by(ordering, reverse, 'ZZZ')
-            elif ordering == 'url':
-                k = lambda x: x.get('url', 'zzz')
-                found = MDContentList(sorted(found, key=k, reverse=reverse))
-            elif ordering == 'weight':
-                k = lambda x: int(x['data']['page'].get('weight', 999999))
-                found = MDContentList(sorted(found, key=k, reverse=reverse))
-            elif ordering.startswith('date'):
-                if ':' in ordering:
-                    dateorder, datefield = ordering.split(':')
-                else:
-                    datefield = 'DATE'
-                found = found.sorted_by_date(
-                    newest_first=reverse, date_key=datefield)
-            else:
-                raise Exception('Unknown ordering for page_match: %s' % ordering)
+            name, k, reverse = _ordering_spec(ordering)
+            found = found._sorted(name, k, reverse)
         if limit and len(found) > limit:
-            found = MDContentList(found[:limit])
+            found = found._derived(found[:limit])
         return found
 
+    def link_index(self):
+        "The LinkIndex for the list, which is built on first use."
+        return self._index('link', LinkIndex)
+
+    def resolve_linkto(self, match, ordering=None, limit=None):
+        """
+        Find the target(s) of a `linkto` shortcode. If `match` is a string it
+        is interpreted heuristically (see the documentation of the shortcode)
+        and resolved via the LinkIndex when possible. Otherwise, or if the
+        string contains regular expression syntax, page_match() is used.
+        """
+        if not isinstance(match, str):
+            return self.page_match(match, ordering=ordering, limit=limit)
+        plain = lambda x: re.match(r'^[\w/ -]*$', x)
+        if match.startswith('^') or match.endswith('$'):
+            expr = [
+                {'slug': match}, {'title': match},
+                {'path': match}, {'url': match}]
+        elif match.endswith('.md'):
+            if plain(match[:-3]):
+                found = self.link_index().by_suffix('path', match)
+                return found.ordered_and_limited(ordering, limit)
+            match = match.replace('.md', r'\.md')
+            expr = [{'path': match+'$'}]
+        elif match.endswith('.html') or match.endswith('/'):
+            if match.endswith('/'):
+                match += 'index.html'
+            if plain(match[:-5]):
+                found = self.link_index().by_suffix('url', match)
+                return found.ordered_and_limited(ordering, limit)
+            match = match.replace('.html', r'\.html')
+            expr = [{'url': match+'$'}]
+        elif '*' in match or '[' in match or '+' in match:
+            expr = [{'title': match}, {'path': match}]
+        elif not ' ' in match and not '/' in match:
+            if re.match(r'^[\w-]+$', match):
+                found = self.link_index().by_name(match)
+                return found.ordered_and_limited(ordering, limit)
+            match = re.sub(r'[ _-]', r'[_ -]', match)
+            expr = [
+                {'slug': '^'+match+'$'},
+                {'title': '^'+match+'$'},
+                {'path': '/'+match+r'\.md$'},
+                {'url': '/'+match+r'(?:\.html|/index\.html)$'}]
+        else:
+            match = r'\b' + match + r'\b'
+            match = re.sub(r'[ _]', r'[_ -]', match)
+            expr = [{'title': match}, {'path': match}]
+        return self.page_match(expr, ordering=ordering, limit=limit)
+
     def write_to(self, dest, context, extra_kwargs=None, template=None):
         """
         Add self to the context as 'CHUNK' and call the calling template again
@@ -645,7 +967,8 @@ class MDContentList(list):
         full_path = os.path.join(context.get('WEBROOT'), dest.strip('/'))
         dest_dir = re.sub(r'/[^/]+$', '', full_path)
         if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
+            # (may be called from several threads; see handle_taxonomy())
+            os.makedirs(dest_dir, exist_ok=True)
         lookup = context.get('LOOKUP') or context.lookup
         try:
             tpl = lookup.get_template(template)
@@ -717,86 +1040,19 @@ class MDContentList(list):
     def get_db(self):
         """
         Get a connection to an in-memory SQLite database representing the pages
-        in the MDContent list.
+        in the MDContent list (see ContentDB). A list derived from another one
+        (e.g. by filtering) shares the database of the latter; its `content`
+        is then a temporary view restricted to the items in the list.
         """
-        if hasattr(self, '_db'):
-            return self._db
-        db = sqlite3.connect(':memory:')
-        db.row_factory = sqlite3.Row
-        def _locale_collation(a, b):
-            va = locale.strxfrm(a)
-            vb = locale.strxfrm(b)
-            return 1 if va > vb else -1 if va < vb else 0
-        db.create_collation('locale', _locale_collation)
-        _casefold = lambda x: x.casefold() if isinstance(x, str) else str(x or '').casefold()
-        db.create_function('casefold', 1, _casefold, deterministic=True)
-        cur = db.cursor()
-        fixed_cols = [
-            'url', 'source_file', 'source_file_short', 'target',
-            'template', 'MTIME', 'DATE', 'doc', 'rendered', ]
-        page_cols = set()
-        guess_type = {}
-        for it in self:
-            pg = it['data']['page']
-            valid_keys = [_ for _ in pg.keys() if re.match(r'^[a-z][a-zA-Z0-9_]*$', _)]
-            for k in valid_keys:
-                page_cols.add('page_' + k)
-                if not k in guess_type:
-                    if isinstance(pg[k], bool):
-                        guess_type[k] = 'bool'
-                    elif isinstance(pg[k], int):
-                        guess_type[k] = 'int'
-                    elif isinstance(pg[k], float):
-                        guess_type[k] = 'numeric'
-                    elif isinstance(pg[k], datetime.date):
-                        guess_type[k] = 'date'
-                    elif isinstance(pg[k], datetime.datetime):
-                        guess_type[k] = 'timestamp'
-                    elif isinstance(pg[k], (list, dict)):
-                        guess_type[k] = 'json'
-                    else:
-                        guess_type[k] = 'text'
-        sql = """
-          CREATE TABLE content (
-            url text,
-            source_file text,
-            source_file_short text,
-            target text,
-            template text,
-            mtime timestamp,
-            "date" timestamp,
-            doc text,
-            rendered text"""
-        for pc in page_cols:
-            sql += ',\n    %s %s' % (pc, guess_type[pc[5:]])
-        sql += "\n);"
-        cur.execute(sql);
-        page_cols_list = list(page_cols)
-        all_cols = fixed_cols + page_cols_list
-        ins_sql = "INSERT INTO content (%s) VALUES (%s)" % (
-            ', '.join(all_cols), ', '.join([':'+_ for _ in all_cols]))
-        def _val(v):
-            if not v and isinstance(v, dict):
-                return None
-            elif isinstance(v, (bool, int, float, str)):
-                return v
-            elif isinstance(v, (datetime.date, datetime.datetime)):
-                return str(v)
-            elif v is None:
-                return None
-            else:
-                return json.dumps(v, default=str, ensure_ascii=False)
-        for it in self:
-            rec = {}
-            for k in fixed_cols:
-                rec[k] = it['data'][k] if k.upper()==k else it[k]
-            for pc in page_cols_list:
-                k = pc[5:]
-                rec[pc] = _val(it['data']['page'].get(k))
-            cur.execute(ins_sql, rec)
-        db.commit()
-        self._db = db
-        return db
+        return self._content_db().conn
+
+    def _content_db(self):
+        "The ContentDB behind get_db()."
+        parent = self._parent_list()
+        if parent is not None:
+            root_db = parent._index('db', ContentDB)
+            return self._index('db', lambda x: root_db.restricted(x))
+        return self._index('db', ContentDB)
 
     def get_db_columns(self):
         """
@@ -811,28 +1067,75 @@ class MDContentList(list):
 
     def page_match_sql(self, where_clause=None, bind=None,
                        order_by=None, limit=None, offset=None,
-                       raw_sql=None, raw_result=False, first=False):
+                       raw_sql=None, raw_result=False, first=False,
+                       fts_match=None):
         """
         Filter this MDContentList by a SQL SELECT statement run against the
         SQLite database generated by self.get_db(). Parameters: `where_clause`
         (string), `bind` (bind values for the where clause), `order_by`
         (string), `limit` (int), `offset` (int), `raw_sql` (string),
-        `raw_result` (string), `first` (bool). Either `where_clause` or
-        `raw_sql` must be specified. If `first` is True, only the first item in
-        the result is returned (or None, if the list of results is empty).
+        `raw_result` (string), `first` (bool), `fts_match` (string). Either
+        `where_clause`, `fts_match` or `raw_sql` must be specified. If `first`
+        is True, only the first item in the result is returned (or None, if the
+        list of results is empty). If `fts_match` is given, only pages matching
+        this full-text query are included and, unless `order_by` is specified,
+        the best matches come first. Results (except raw ones) are memoized
+        until the list is modified.
         """
+        if not (where_clause or raw_sql or fts_match):
+            raise Exception('Need either where_clause, fts_match or raw_sql')
+        if raw_sql and fts_match:
+            raise Exception('Cannot combine raw_sql and fts_match')
+        memo_key = None
+        if not raw_result:
+            try:
+                memo_key = json.dumps(
+                    [where_clause, bind, order_by, limit, offset, raw_sql,
+                     first, fts_match],
+                    sort_keys=True, default=str)
+            except (TypeError, ValueError):
+                pass
+        memo = self._index('page_match_sql', lambda x: {})
+        if memo_key is not None and memo_key in memo:
+            found = memo[memo_key]
+            return found if first else self._derived(found)
         db = self.get_db()
         cur = db.cursor()
-        if not (where_clause or raw_sql):
-            raise Exception('Need either where_clause or raw_sql')
         if raw_sql:
             sql = raw_sql
             if not raw_result and not 'source_file' in sql.lower():
                 raise Exception(
                     'The raw_sql has no source_file column')
+        elif fts_match:
+            if not self._content_db().ensure_fts():
+                raise Exception('Full-text search (FTS5) is not available')
+            # The rank is available as the column fts_rank
+            if isinstance(bind, dict):
+                bind = dict(bind)
+                bind['_fts_match'] = fts_match
+                param = ':_fts_match'
+            else:
+                bind = [fts_match] + list(bind or [])
+                param = '?'
+            sql = """
+              WITH fts AS (
+                SELECT source_file AS fts_source_file,
+                       {0} AS fts_rank
+                FROM content_fts WHERE content_fts MATCH {1})
+              SELECT {2} FROM content JOIN fts ON fts_source_file = source_file
+              WHERE {3}""".format(
+                  ContentDB.FTS_RANK, param,
+                  '*' if raw_result else 'source_file', where_clause or '1')
+            if not order_by:
+                order_by = 'fts_rank'
         else:
             sql = "SELECT {0} FROM content WHERE {1}".format(
                 '*' if raw_result else 'source_file', where_clause)
+        if not raw_sql:
+            # Ties (and everything, if there is no order_by) are in the order
+            # of the list
+            order_by = '{}, position'.format(order_by) if order_by \
+                else 'position'
         if order_by:
             sql += ' ORDER BY {}'.format(order_by)
         if limit:
@@ -846,67 +1149,1982 @@ class MDContentList(list):
             self_as_dict = dict([(_['source_file'], _) for _ in self])
             if first:
                 it = res.fetchone()
-                return self_as_dict[it['source_file']] if it else it
+                found = self_as_dict[it['source_file']] if it else it
+                if memo_key is not None:
+                    memo[memo_key] = found
+                return found
             res_as_list = [self_as_dict[_['source_file']] for _ in res.fetchall()]
-            return MDContentList(res_as_list)
+            if memo_key is not None:
+                memo[memo_key] = res_as_list
+            return self._derived(res_as_list)
+
+    def search(self, query, limit=None, where_clause=None, bind=None):
+        """
+        Full-text search in the title, markdown source and rendered text of the
+        pages in the list, using the SQLite FTS5 query syntax (e.g.
+        `'python OR ruby'`, `'"exact phrase"'`, `'title:python'`). Returns an
+        MDContentList with the best matches (according to BM25) first.
+        """
+        return self.page_match_sql(
+            where_clause=where_clause, bind=bind, limit=limit, fts_match=query)
+
+    def query(self):
+        """
+        A lazy ContentQuery on this list, for chaining filters, ordering and
+        slicing which are only evaluated when the result is actually used.
+        """
+        return ContentQuery(self)
+
+
+try:
+    # Python 3.14+
+    from compression import zstd as _zstd
+    _zstd_compress = lambda data: _zstd.compress(data, 3)
+    _zstd_decompress = _zstd.decompress
+except ImportError:
+    try:
+        import zstandard as _zstd
+        _zstd_compress = lambda data: _zstd.ZstdCompressor(level=3).compress(data)
+        _zstd_decompress = lambda data: _zstd.ZstdDecompressor().decompress(data)
+    except ImportError:
+        _zstd = None
+
+
+_file_hashes = {}
+
+def file_hash(path):
+    """
+    SHA1 hex digest of the contents of a file, or None if it does not exist.
+    Memoized on the path, size and modification time of the file.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        with open(path, 'rb') as f:
+            _file_hashes[memo_key] = hashlib.sha1(f.read()).hexdigest()
+    return _file_hashes[memo_key]
+
+
+_file_contents = {}
+
+def file_contents(path, default=None):
+    """
+    Text contents of a file (or `default` if it does not exist), e.g. for the
+    include() shortcode. Memoized like file_hash(), so that a file which is
+    included by many pages is only read once per build (and only read again
+    after it has changed).
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return default
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_contents:
+        with open(path, 'rb') as f:
+            data = f.read()
+        _file_hashes[memo_key] = hashlib.sha1(data).hexdigest()
+        _file_contents[memo_key] = data.decode('utf-8')
+    return _file_contents[memo_key]
+
+
+def _is_post(it):
+    "Whether a content item is a blog post (see MDContentList.posts())."
+    return (it['source_file_short'].strip('/').startswith(('posts/', 'blog/'))
+            or it['data']['page'].get('type', '') in (
+                'post', 'blog', 'blog-entry', 'blog_entry'))
+
+
+def _callable_key(fn):
+    """
+    A hashable value identifying what the callable `fn` does, so that e.g. a
+    lambda defined in a template is recognized as the same function each time
+    the template is rendered; or None if there is no such value.
+    """
+    if fn is None:
+        return None
+    code = getattr(fn, '__code__', None)
+    if code is None:
+        # E.g. a builtin or a class
+        ret = fn
+    else:
+        ret = (code, fn.__defaults__,
+               tuple([_.cell_contents for _ in fn.__closure__ or ()]))
+    try:
+        hash(ret)
+    except TypeError:
+        return None
+    return ret
+
+
+def _page_sort_key(key, default_val):
+    "The (name, key function) for MDContentList.sorted_by()."
+    if isinstance(default_val, str):
+        k = lambda x: _strxfrm(x['data']['page'].get(key, default_val))
+    else:
+        k = lambda x: x['data']['page'].get(key, default_val)
+    return (('page', key, default_val), k)
+
+
+def _date_sort_key(date_key='DATE'):
+    "The (name, key function) for MDContentList.sorted_by_date()."
+    k = lambda x: str(
+        x['data'][date_key]
+          if date_key in ('DATE', 'MTIME') \
+          else x['data']['page'].get(date_key, x['data']['DATE']))
+    return (('date', date_key), k)
+
+
+def _ordering_spec(ordering):
+    """
+    The (name, key function, reverse) for an `ordering` as accepted by
+    MDContentList.page_match(), i.e. title, slug, url, weight or date (or
+    date:<field>), optionally preceded by `-` for reverse ordering.
+    """
+    reverse = False
+    if ordering[0] == '-':
+        reverse = True
+        ordering = ordering[1:]
+    if ordering in ('title', 'slug'):
+        return _page_sort_key(ordering, 'ZZZ') + (reverse, )
+    elif ordering == 'url':
+        return (('url', ), lambda x: x.get('url', 'zzz'), reverse)
+    elif ordering == 'weight':
+        return (('weight', ),
+                lambda x: int(x['data']['page'].get('weight', 999999)),
+                reverse)
+    elif ordering.startswith('date'):
+        if ':' in ordering:
+            dateorder, datefield = ordering.split(':')
+        else:
+            datefield = 'DATE'
+        return _date_sort_key(datefield) + (reverse, )
+    raise Exception('Unknown ordering for page_match: %s' % ordering)
+
+
+def _in_date_range(ctx, start, end, date_key='DATE'):
+    "Whether the date of the page with context `ctx` is between `start` and `end`."
+    std = lambda ts: str(ts).replace(' ', 'T')  # standard ISO fmt
+    pg = ctx['page']
+    date = ctx[date_key] if date_key in ('DATE', 'MTIME') else pg.get(date_key, ctx['DATE'])
+    return std(start) <= std(date) <= std(end)
+
+
+def _has_taxon(pg, keys, needles):
+    """
+    Whether the page `pg` has any of `needles` in the taxonomy characterized by
+    `keys`, in the same way as MDContentList.has_taxonomy().
+    """
+    if not needles:
+        return False
+    if not isinstance(needles, (list, tuple)):
+        needles = [needles]
+    is_bool = len(needles) == 1 and isinstance(needles[0], bool) and needles[0]
+    if not is_bool:
+        needles = [_.lower() for _ in needles]
+    for k in keys:
+        val = pg.get(k)
+        if not val:
+            continue
+        if is_bool:
+            return True
+        for term in (val if isinstance(val, (list, tuple)) else [val]):
+            if term and isinstance(term, str) and term.lower() in needles:
+                return True
+    return False
+
+
+PAGE_MATCH_CONDITIONS = (
+    'title', 'slug', 'id', 'url', 'path', 'doc', 'date_range',
+    'has_attrs', 'attrs', 'has_tag', 'in_section', 'in_category',
+    'is_post', 'exclude_url')
+
+_page_match_plans = {}
+
+def _page_match_plan(match_expr, inverse=False):
+    """
+    Compiles a page_match() condition dict into a query plan: a dict with the
+    keys `narrow` (a list of (method, argument) pairs for index lookups which
+    reduce the number of candidates) and `checks` (a list of callables
+    receiving an item and its page, ordered from cheap to expensive). Plans are
+    memoized on the condition dict.
+    """
+    if not match_expr:
+        raise Exception('No condition for page_match')
+    for k in match_expr:
+        if not k in PAGE_MATCH_CONDITIONS:
+            raise Exception('Unknown condition for page_match: %s' % k)
+    try:
+        plan_key = json.dumps([match_expr, inverse], sort_keys=True, default=str)
+    except (TypeError, ValueError):
+        plan_key = None
+    if plan_key is not None and plan_key in _page_match_plans:
+        return _page_match_plans[plan_key]
+    x = match_expr
+    boolval = lambda v: not bool(v) if inverse else bool(v)
+    narrow = []
+    checks = []
+    if 'exclude_url' in x:
+        # Normalize both URLs somewhat
+        x_url = x['exclude_url'].replace('/index.html', '/')
+        checks.append(
+            lambda c, p: c['url'].replace('/index.html', '/') != x_url)
+    if 'id' in x:
+        idlist = (x['id'], ) if isinstance(x['id'], str) else x['id']
+        checks.append(lambda c, p: boolval(p['id'] in idlist))
+        if not inverse:
+            narrow.append(('has_id', x['id']))
+    if 'has_attrs' in x:
+        attrnames = x['has_attrs']
+        checks.append(
+            lambda c, p: all([boolval(p.get(a)) for a in attrnames]))
+    if 'attrs' in x:
+        attrs = [(k, str(v).lower()) for k, v in x['attrs'].items()]
+        checks.append(lambda c, p: all([
+            boolval(str(p.get(k, '')).lower() == v) for k, v in attrs]))
+    if 'is_post' in x:
+        want_post = bool(x['is_post'])
+        checks.append(lambda c, p: boolval(_is_post(c)) == want_post)
+    for cond, keys in (('has_tag', ('tag', 'tags')),
+                       ('in_section', ('section', 'sections')),
+                       ('in_category', ('category', 'categories'))):
+        if cond in x:
+            checks.append(
+                lambda c, p, keys=keys, needles=x[cond]: boolval(
+                    _has_taxon(p, keys, needles)))
+            if not inverse:
+                narrow.append((cond, x[cond]))
+    for k in ('title', 'slug'):
+        if k in x:
+            rx = re.compile(x[k], flags=re.I)
+            checks.append(
+                lambda c, p, k=k, rx=rx: boolval(rx.search(p.get(k, ''))))
+    for k, field in (('url', 'url'), ('path', 'source_file_short')):
+        if k in x:
+            rx = re.compile(x[k], flags=re.I)
+            checks.append(
+                lambda c, p, field=field, rx=rx: boolval(rx.search(c[field])))
+    if 'date_range' in x:
+        date_range = x['date_range']
+        checks.append(
+            lambda c, p: boolval(_in_date_range(c['data'], *date_range)))
+    if 'doc' in x:
+        rx = re.compile(x['doc'], flags=re.I)
+        checks.append(lambda c, p: boolval(rx.search(c['doc'])))
+    plan = {'narrow': narrow, 'checks': checks}
+    if plan_key is not None:
+        if len(_page_match_plans) > 5000:
+            _page_match_plans.clear()
+        _page_match_plans[plan_key] = plan
+    return plan
+
+
+def _field_index(getter):
+    """
+    Returns a function which builds an index (a dict from values to lists of
+    positions) of an MDContentList based on the value returned by `getter` for
+    each item. Unhashable values are left out.
+    """
+    def build(items):
+        index = {}
+        for i, it in enumerate(items):
+            val = getter(it)
+            try:
+                if val not in index:
+                    index[val] = []
+            except TypeError:
+                continue
+            index[val].append(i)
+        return index
+    return build
+
+
+def _taxonomy_index(keys):
+    """
+    Returns a function which builds an index of an MDContentList based on the
+    lowercased string values of the page variables in `keys` (e.g.
+    `('tag', 'tags')`). The key True refers to all items with a non-empty value
+    for any of them.
+    """
+    def build(items):
+        index = {True: []}
+        for i, it in enumerate(items):
+            pg = it['data']['page']
+            terms = set()
+            for k in keys:
+                val = pg.get(k)
+                if not val:
+                    continue
+                terms.add(True)
+                for term in (val if isinstance(val, (list, tuple)) else [val]):
+                    if term and isinstance(term, str):
+                        terms.add(term.lower())
+            for term in terms:
+                if term not in index:
+                    index[term] = []
+                index[term].append(i)
+        return index
+    return build
+
+
+def _mdcontentlist_mutator(name):
+    orig = getattr(list, name)
+    def mutator(self, *args, **kwargs):
+        if name == 'append':
+            self._changed(added=args)
+        elif name in ('extend', '__iadd__'):
+            args = (list(args[0]), )
+            self._changed(added=args[0])
+        else:
+            self._changed()
+        return orig(self, *args, **kwargs)
+    mutator.__name__ = name
+    mutator.__doc__ = orig.__doc__
+    return mutator
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(MDContentList, _name, _mdcontentlist_mutator(_name))
+
+
+class ContentQuery:
+    """
+    A lazy view of an MDContentList, as returned by MDContentList.query(). The
+    filtering methods of MDContentList (such as `posts()`, `has_tag()` or
+    `in_date_range()`), sorting methods and slicing return a new ContentQuery
+    rather than a new list. When the query is used like a list (iterated,
+    indexed, measured with `len()` or used as an MDContentList in any other
+    way), it is evaluated in one pass over the source list:
+
+    - Filters which can use an index of the list (e.g. `has_tag()` or
+      `has_id()`) are applied first; other filters only look at the
+      remaining items.
+    - If the whole list is to be sorted, its cached sorted version is scanned
+      and scanning stops as soon as enough items have been found for the
+      slice, if any. Otherwise, only the top N items are selected using a heap
+      for a slice such as `[:N]`.
+
+    An exception is `page_match()` with a list of several match expressions,
+    whose result is ordered by match expression: the query up to that point
+    is evaluated immediately, and the rest of the query works on the result.
+    This way the result is the same as that of the corresponding chain of
+    MDContentList calls.
+    """
+    # How many lookup results are memoized per source list (see _lookup_result)
+    LOOKUP_MEMO_SIZE = 256
+
+    def __init__(self, source, filters=None, lookups=None, orderings=None,
+                 start=0, stop=None):
+        self._source = source
+        self._filters = filters or []    # predicates on an item
+        self._lookups = lookups or []    # (method_name, args)
+        self._orderings = orderings or []  # (name, key, reverse)
+        self._start = start
+        self._stop = stop
+        self._result = None
+
+    def _with(self, filters=(), lookups=(), orderings=()):
+        # A new query with additional steps; filtering or sorting a sliced
+        # query means working on the result of the latter.
+        if (filters or lookups or orderings) and (self._start or self._stop is not None):
+            return ContentQuery(self.evaluate())._with(filters, lookups, orderings)
+        return ContentQuery(
+            self._source, self._filters + list(filters),
+            self._lookups + list(lookups), self._orderings + list(orderings),
+            self._start, self._stop)
+
+    def _sliced(self, start, stop):
+        start = start or 0
+        if self._stop is not None:
+            stop = self._stop if stop is None else min(self._stop, self._start + stop)
+        elif stop is not None:
+            stop = self._start + stop
+        return ContentQuery(
+            self._source, self._filters, self._lookups, self._orderings,
+            self._start + start, stop)
+
+    # Filtering (see the MDContentList methods of the same name)
+
+    def match_entry(self, pred):
+        return self._with(filters=[pred])
+
+    def match_ctx(self, pred):
+        return self._with(filters=[lambda x: pred(x['data'])])
+
+    def match_page(self, pred):
+        return self._with(filters=[lambda x: pred(x['data']['page'])])
+
+    def match_doc(self, pred):
+        return self._with(filters=[lambda x: pred(x['doc'])])
+
+    def posts(self, ordered=True):
+        ret = self._with(filters=[_is_post])
+        return ret.sorted_by_date() if ordered else ret
+
+    def non_posts(self):
+        return self._with(filters=[lambda x: not _is_post(x)])
+
+    def in_date_range(self, start, end, date_key='DATE'):
+        return self._with(filters=[
+            lambda x: _in_date_range(x['data'], start, end, date_key)])
+
+    def has_slug(self, sluglist):
+        return self._with(lookups=[('has_slug', (sluglist, ))])
+
+    def has_id(self, idlist):
+        return self._with(lookups=[('has_id', (idlist, ))])
+
+    def url_match(self, url_pred):
+        if callable(url_pred):
+            return self._with(filters=[lambda x: url_pred(x['url'])])
+        return self._with(lookups=[('url_match', (url_pred, ))])
+
+    def path_match(self, src_pred):
+        if callable(src_pred):
+            return self._with(filters=[lambda x: src_pred(x['source_file_short'])])
+        return self._with(lookups=[('path_match', (src_pred, ))])
+
+    def has_taxonomy(self, haystack_keys, needles):
+        return self._with(lookups=[('has_taxonomy', (haystack_keys, needles))])
+
+    def in_category(self, catlist):
+        return self.has_taxonomy(['category', 'categories'], catlist)
+
+    def has_tag(self, taglist):
+        return self.has_taxonomy(['tag', 'tags'], taglist)
+
+    def in_section(self, sectionlist):
+        return self.has_taxonomy(['section', 'sections'], sectionlist)
+
+    def page_match(self, match_expr, ordering=None, limit=None, inverse=False):
+        if isinstance(match_expr, (list, tuple)) and len(match_expr) > 1:
+            # The union is ordered by match_expr rather than by the source
+            # list, so the query so far has to be evaluated first.
+            base = self._source if self._is_plain() else self.evaluate()
+            ret = ContentQuery(base.page_match(match_expr, inverse=inverse))
+        else:
+            ret = self._with(
+                lookups=[('page_match', (match_expr, None, None, inverse))])
+        return ret.ordered_and_limited(ordering, limit)
+
+    # Ordering and slicing
+
+    def sorted_by(self, key, reverse=False, default_val=-1):
+        name, k = _page_sort_key(key, default_val)
+        return self._with(orderings=[(name, k, reverse)])
+
+    def sorted_by_date(self, newest_first=True, date_key='DATE'):
+        name, k = _date_sort_key(date_key)
+        return self._with(orderings=[(name, k, newest_first)])
+
+    def sorted_by_title(self, reverse=False):
+        return self.sorted_by('title', reverse=reverse, default_val='ZZZ')
+
+    def ordered_and_limited(self, ordering=None, limit=None):
+        ret = self._with(orderings=[_ordering_spec(ordering)]) if ordering else self
+        return ret._sliced(0, limit) if limit else ret
+
+    def limit(self, limit):
+        "At most `limit` items."
+        return self._sliced(0, limit)
+
+    # Evaluation
+
+    def _is_plain(self):
+        "Whether the query is the unchanged source list."
+        return not (self._filters or self._lookups or self._orderings
+                    or self._start or self._stop is not None)
+
+    def evaluate(self):
+        "The result of the query as an MDContentList."
+        if self._result is None:
+            self._result = self._evaluate()
+        return self._result
+
+    def _lookup_result(self, name, args):
+        # The items found by an index-based method of the source list, along
+        # with a set of their ids; memoized until the source list changes.
+        # Only the most recently used LOOKUP_MEMO_SIZE results are kept.
+        memo = self._source._index('query_lookups', lambda x: OrderedDict())
+        try:
+            memo_key = json.dumps([name, args], sort_keys=True, default=str)
+        except (TypeError, ValueError):
+            memo_key = None
+        if memo_key is not None:
+            ret = memo.get(memo_key)
+            if ret is not None:
+                try:
+                    memo.move_to_end(memo_key)
+                except KeyError:
+                    # Evicted by another thread in the meantime
+                    pass
+                return ret
+        found = getattr(self._source, name)(*args)
+        ret = (found, set([id(_) for _ in found]))
+        if memo_key is not None:
+            memo[memo_key] = ret
+            while len(memo) > self.LOOKUP_MEMO_SIZE:
+                try:
+                    memo.popitem(last=False)
+                except KeyError:
+                    break
+        return ret
+
+    def _evaluate(self):
+        source = self._source
+        found = [self._lookup_result(name, args) for name, args in self._lookups]
+        candidates = source
+        if found:
+            found.sort(key=lambda x: len(x[0]))
+            candidates = found[0][0]
+        # Membership in the results of the other lookups is checked first
+        filters = [(lambda x, ids=ids: id(x) in ids) for lst, ids in found[1:]]
+        filters += self._filters
+        matches = lambda x: all(f(x) for f in filters)
+        wanted = self._stop
+        ordering = self._orderings[0] if len(self._orderings) == 1 else None
+        if ordering is not None:
+            name, key, reverse = ordering
+            try:
+                hash(name)
+            except TypeError:
+                ordering = None
+        if ordering is not None and (
+                wanted is not None or len(candidates) * 4 >= len(source)):
+            # Scan the (cached) sorted version of the whole list
+            try:
+                view = source._sorted_view(name, key, reverse)
+            except Exception:
+                # e.g. incomparable keys in items which are filtered out
+                view = None
+            if view is not None:
+                ids = found[0][1] if found else None
+                ret = []
+                for it in view:
+                    if wanted is not None and len(ret) >= wanted:
+                        break
+                    if (ids is None or id(it) in ids) and matches(it):
+                        ret.append(it)
+                return source._derived(ret[self._start:])
+        ret = [_ for _ in candidates if matches(_)]
+        if ordering is not None:
+            keys = dict([(id(_), key(_)) for _ in ret])
+            sort_key = lambda x: keys[id(x)]
+            if wanted is not None and wanted < len(ret):
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                ret = select(wanted, ret, key=sort_key)
+            else:
+                ret = sorted(ret, key=sort_key, reverse=reverse)
+        else:
+            for name, key, reverse in self._orderings:
+                ret = sorted(ret, key=key, reverse=reverse)
+        return source._derived(ret[self._start:wanted])
+
+    def __iter__(self):
+        return iter(self.evaluate())
+
+    def __len__(self):
+        return len(self.evaluate())
+
+    def __bool__(self):
+        return len(self.evaluate()) > 0
+
+    def __contains__(self, item):
+        return item in self.evaluate()
+
+    def __reversed__(self):
+        return reversed(self.evaluate())
+
+    def __add__(self, other):
+        return self.evaluate() + list(other)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice) and idx.step is None \
+                and (idx.start or 0) >= 0 and (idx.stop is None or idx.stop >= 0):
+            return self._sliced(idx.start, idx.stop)
+        return self.evaluate()[idx]
+
+    def __getattr__(self, name):
+        # Any other MDContentList method or attribute works on the result
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.evaluate(), name)
+
+    def __repr__(self):
+        return 'ContentQuery(%r)' % self.evaluate()
+
+
+@functools.lru_cache(maxsize=100000)
+def _strxfrm(val):
+    return locale.strxfrm(val)
+
+
+def _locale_collation(a, b):
+    va = _strxfrm(a)
+    vb = _strxfrm(b)
+    return 1 if va > vb else -1 if va < vb else 0
+
+
+def _casefold(val):
+    return val.casefold() if isinstance(val, str) else str(val or '').casefold()
+
+
+class ContentDB:
+    """
+    In-memory SQLite database for an MDContentList. The `content` table has
+    one row per item; see the documentation of get_db() in the readme. In
+    addition:
+
+    - Columns named `sortkey_<field>` hold `locale.strxfrm()` of the `title`
+      and some other common text fields, so that e.g.
+      `ORDER BY sortkey_title` sorts in a locale-sensitive way without calling
+      back into Python for each comparison (as the `locale` collation does).
+    - The tables `content_tags`, `content_categories` and `content_authors`
+      (with the columns `source_file`, `name` and `slug`) hold one row for each
+      tag, category or author of each item.
+    - There are indexes on `url`, `source_file`, `date` and a few common page
+      columns, as well as on the above tables.
+    - If the SQLite library supports FTS5, the virtual table `content_fts` is
+      a full-text index of the `title`, `doc` (markdown source) and `body`
+      (rendered HTML stripped of tags) of each item, keyed on `source_file`.
+      Since this is relatively costly, it is only built when first needed
+      (see `ensure_fts()`).
+
+    The database is opened with a shared-cache URI so that lists derived from
+    this one can attach to it with their own connection and a temporary
+    `content` view (see `restricted()`) rather than building a new database.
+    """
+    FIXED_COLS = [
+        'url', 'source_file', 'source_file_short', 'target',
+        'template', 'MTIME', 'DATE', 'doc', 'rendered', ]
+    SORTKEY_FIELDS = ('title', 'name', 'author', 'category', 'section')
+    INDEXED_FIELDS = ('id', 'slug', 'title', 'type', 'weight', 'date',
+                      'draft', 'category', 'section', 'author')
+    TAXONOMIES = {
+        'tags': ('tag', 'tags'),
+        'categories': ('category', 'categories'),
+        'authors': ('author', 'authors'),
+    }
+    # BM25 ranking for content_fts, with matches in the title weighted higher
+    FTS_RANK = 'bm25(content_fts, 0.0, 10.0, 1.0, 1.0)'
+    _counter = 0
+    _lock = threading.Lock()
+
+    def __init__(self, items=None):
+        with ContentDB._lock:
+            ContentDB._counter += 1
+            self.uri = 'file:wmk_content_%d_%d?mode=memory&cache=shared' % (
+                os.getpid(), ContentDB._counter)
+        self.conn = self.connect()
+        self.items = []
+        self.fts = None
+        self.fts_lock = threading.Lock()
+        if items is not None:
+            self.load(items)
+
+    def connect(self):
+        db = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.create_collation('locale', _locale_collation)
+        db.create_function('casefold', 1, _casefold, deterministic=True)
+        return db
+
+    @staticmethod
+    def _val(v):
+        if not v and isinstance(v, dict):
+            return None
+        elif isinstance(v, (bool, int, float, str)):
+            return v
+        elif isinstance(v, (datetime.date, datetime.datetime)):
+            return str(v)
+        elif v is None:
+            return None
+        else:
+            return json.dumps(v, default=str, ensure_ascii=False)
+
+    @staticmethod
+    def _guess_type(v):
+        if isinstance(v, bool):
+            return 'bool'
+        elif isinstance(v, int):
+            return 'int'
+        elif isinstance(v, float):
+            return 'numeric'
+        elif isinstance(v, datetime.date):
+            return 'date'
+        elif isinstance(v, datetime.datetime):
+            return 'timestamp'
+        elif isinstance(v, (list, dict)):
+            return 'json'
+        return 'text'
+
+    @staticmethod
+    def _taxon_name(v):
+        if isinstance(v, dict) and 'name' in v:
+            return str(v['name'])
+        return v if isinstance(v, str) else str(v)
+
+    @classmethod
+    def page_columns(cls, items):
+        """
+        Returns a tuple of (page_cols, col_types) for the `page_*` columns
+        (in order of first appearance) and the `sortkey_*` columns.
+        """
+        page_cols = []
+        col_types = {}
+        for it in items:
+            pg = it['data']['page']
+            for k in pg.keys():
+                if 'page_' + k in col_types or not re.match(r'^[a-z][a-zA-Z0-9_]*$', k):
+                    continue
+                col_types['page_' + k] = cls._guess_type(pg[k])
+                page_cols.append('page_' + k)
+        for k in cls.SORTKEY_FIELDS:
+            if 'page_' + k in col_types:
+                page_cols.append('sortkey_' + k)
+                col_types['sortkey_' + k] = 'text'
+        return (page_cols, col_types)
+
+    @classmethod
+    def item_row(cls, it, page_cols):
+        "Values for the FIXED_COLS followed by `page_cols` for an item."
+        pg = it['data']['page']
+        row = [it['data'][k] if k.upper()==k else it[k]
+               for k in cls.FIXED_COLS]
+        for col in page_cols:
+            if col.startswith('sortkey_'):
+                v = pg.get(col[8:])
+                row.append(_strxfrm(v) if isinstance(v, str) else None)
+            else:
+                row.append(cls._val(pg.get(col[5:])))
+        return row
+
+    @classmethod
+    def item_taxons(cls, it):
+        "A dict of rows (source_file, name, slug) for each taxonomy table."
+        pg = it['data']['page']
+        ret = {}
+        for tbl, keys in cls.TAXONOMIES.items():
+            ret[tbl] = []
+            seen = set()
+            for k in keys:
+                vals = pg.get(k)
+                if not vals:
+                    continue
+                if not isinstance(vals, (list, tuple)):
+                    vals = [vals]
+                for v in vals:
+                    if not v:
+                        continue
+                    name = cls._taxon_name(v)
+                    if name in seen:
+                        continue
+                    seen.add(name)
+                    ret[tbl].append((it['source_file'], name, slugify(name)))
+        return ret
+
+    @classmethod
+    def item_fts(cls, it):
+        "The row for content_fts for an item."
+        return (it['source_file'], str(it['data']['page'].get('title') or ''),
+                it.get('doc') or '', cls.html_text(it.get('rendered')))
+
+    @classmethod
+    def create_tables(cls, cur, page_cols, col_types, with_fts=True):
+        """
+        Creates the content table, the taxonomy tables and (if possible and
+        `with_fts` is true) content_fts. Returns False if FTS5 is not
+        available or content_fts was not requested.
+        """
+        sql = """
+          CREATE TABLE content (
+            url text,
+            source_file text,
+            source_file_short text,
+            target text,
+            template text,
+            mtime timestamp,
+            "date" timestamp,
+            doc text,
+            rendered text,
+            position int"""
+        for pc in page_cols:
+            sql += ',\n    %s %s' % (pc, col_types[pc])
+        sql += "\n);"
+        cur.execute(sql)
+        for tbl in cls.TAXONOMIES:
+            cur.execute("""
+              CREATE TABLE content_%s (
+                source_file text not null,
+                name text not null,
+                slug text not null
+              )""" % tbl)
+        return cls.create_fts_table(cur) if with_fts else False
+
+    @staticmethod
+    def create_fts_table(cur):
+        "Creates content_fts. Returns False if FTS5 is not available."
+        try:
+            cur.execute("""
+              CREATE VIRTUAL TABLE content_fts USING fts5(
+                source_file UNINDEXED, title, doc, body)""")
+        except sqlite3.OperationalError:
+            # No FTS5 support in this SQLite build
+            return False
+        return True
+
+    @classmethod
+    def create_indexes(cls, cur, page_cols):
+        "Creates those indexes which do not exist yet."
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS content_source_file ON content (source_file)")
+        cur.execute("CREATE INDEX IF NOT EXISTS content_url ON content (url)")
+        cur.execute('CREATE INDEX IF NOT EXISTS content_date ON content ("date")')
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS content_position ON content (position)")
+        for col in page_cols:
+            if col.startswith('sortkey_') or col[5:] in cls.INDEXED_FIELDS:
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS content_%s ON content (%s)" % (
+                        col, col))
+        for tbl in cls.TAXONOMIES:
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS content_%s_slug ON content_%s (slug)" % (
+                    tbl, tbl))
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS content_%s_source ON content_%s (source_file)" % (
+                    tbl, tbl))
+
+    def load(self, items):
+        page_cols, col_types = self.page_columns(items)
+        cur = self.conn.cursor()
+        self.create_tables(cur, page_cols, col_types, with_fts=False)
+        self.items = items
+        all_cols = ['position'] + self.FIXED_COLS + page_cols
+        ins_sql = "INSERT INTO content (%s) VALUES (%s)" % (
+            ', '.join(all_cols), ', '.join(['?' for _ in all_cols]))
+        cur.executemany(ins_sql, [[i] + self.item_row(it, page_cols)
+                                  for i, it in enumerate(items)])
+        for tbl in self.TAXONOMIES:
+            cur.executemany(
+                "INSERT INTO content_%s VALUES (?, ?, ?)" % tbl,
+                [row for it in items for row in self.item_taxons(it)[tbl]])
+        self.create_indexes(cur, page_cols)
+        self.conn.commit()
+
+    def ensure_fts(self):
+        """
+        Creates and fills content_fts unless this has been done already.
+        A restricted database (see `restricted()`) uses the table of the one
+        it was derived from. Returns False if FTS5 is not available.
+        """
+        if getattr(self, 'parent', None) is not None:
+            return self.parent.ensure_fts()
+        with self.fts_lock:
+            if self.fts is None:
+                cur = self.conn.cursor()
+                self.fts = self.create_fts_table(cur)
+                if self.fts:
+                    cur.executemany(
+                        "INSERT INTO content_fts VALUES (?, ?, ?, ?)",
+                        [self.item_fts(it) for it in self.items])
+                self.conn.commit()
+        return self.fts
+
+    @staticmethod
+    def html_text(html):
+        "The text content of an HTML fragment (roughly)."
+        if not html or not isinstance(html, str):
+            return ''
+        html = re.sub(r'<(script|style)\b.*?</\1\s*>', ' ', html,
+                      flags=re.S|re.I)
+        return unescape(re.sub(r'<[^>]*>', ' ', html))
+
+    @staticmethod
+    def has_fts(conn):
+        "Whether the database behind the connection has the content_fts table."
+        return bool(conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE name = 'content_fts'"
+        ).fetchone())
+
+    def restricted(self, items):
+        """
+        A ContentDB sharing the data of this one through a new connection, in
+        which `content` is a temporary view containing only `items` (which
+        must be a subset of the items in this database). Its `position` column
+        is the position of the item in `items`.
+        """
+        ret = ContentDB.__new__(ContentDB)
+        ret.uri = self.uri
+        ret.parent = self  # keeps the shared in-memory database alive
+        ret.conn = ret.connect()
+        cur = ret.conn.cursor()
+        cur.execute("""
+          CREATE TEMP TABLE members (
+            source_file text primary key,
+            position int
+          )""")
+        cur.executemany(
+            "INSERT OR IGNORE INTO members VALUES (?, ?)",
+            [(_['source_file'], i) for i, _ in enumerate(items)])
+        cols = [_[1] for _ in cur.execute("PRAGMA main.table_info(content)")]
+        cur.execute("""
+          CREATE TEMP VIEW content AS
+            SELECT %s FROM main.content AS c
+            JOIN temp.members AS m ON m.source_file = c.source_file""" % ', '.join(
+                ['m.position AS position' if _ == 'position' else 'c."%s"' % _
+                 for _ in cols]))
+        ret.conn.commit()
+        return ret
+
+
+class PersistentContentDB(ContentDB):
+    """
+    A ContentDB stored in an SQLite file which is kept up to date between
+    builds, so that external tools can query the content metadata without
+    running wmk. The schema is the same as that of ContentDB, except for the
+    additional table `content_hashes` (`source_file`, `row_hash`) which is
+    used by `update()` to write only the rows that have actually changed.
+    Columns for front matter fields which no longer occur are kept but hold
+    NULL values.
+    """
+    # Increase when the schema changes; the file is then rebuilt from scratch
+    SCHEMA_VERSION = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = self.connect()
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION and self.table_columns():
+            self.conn.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+            self.conn = self.connect()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.create_collation('locale', _locale_collation)
+        db.create_function('casefold', 1, _casefold, deterministic=True)
+        db.execute("PRAGMA journal_mode = WAL")
+        return db
+
+    def close(self):
+        self.conn.close()
+
+    def table_columns(self):
+        return [_[1] for _ in self.conn.execute("PRAGMA table_info(content)")]
+
+    @staticmethod
+    def row_hash(cols, row):
+        return hashlib.sha1(json.dumps(
+            [(c, v) for c, v in zip(cols, row) if v is not None],
+            default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def update(self, items):
+        """
+        Brings the database up to date with `items` by rewriting the rows of
+        new or changed items and deleting those of items which are gone.
+        Returns a tuple of (number_of_changed, number_of_removed).
+        """
+        page_cols, col_types = self.page_columns(items)
+        cur = self.conn.cursor()
+        cur.execute("BEGIN")
+        existing_cols = self.table_columns()
+        if not existing_cols:
+            self.create_tables(cur, page_cols, col_types)
+            cur.execute("""
+              CREATE TABLE content_hashes (
+                source_file text primary key,
+                row_hash text not null
+              )""")
+            cur.execute("PRAGMA user_version = %d" % self.SCHEMA_VERSION)
+        else:
+            for col in page_cols:
+                if not col.lower() in [_.lower() for _ in existing_cols]:
+                    cur.execute("ALTER TABLE content ADD COLUMN %s %s" % (
+                        col, col_types[col]))
+        all_cols = self.FIXED_COLS + page_cols
+        old_hashes = dict(cur.execute(
+            "SELECT source_file, row_hash FROM content_hashes").fetchall())
+        changed = {}
+        for it in items:
+            row = self.item_row(it, page_cols)
+            row_hash = self.row_hash(all_cols, row)
+            if old_hashes.get(it['source_file']) != row_hash:
+                changed[it['source_file']] = (it, row, row_hash)
+        current = set([_['source_file'] for _ in items])
+        removed = [_ for _ in old_hashes if not _ in current]
+        has_fts = self.has_fts(self.conn)
+        stale = [(_, ) for _ in list(changed.keys()) + removed]
+        tables = ['content', 'content_hashes'] + [
+            'content_' + _ for _ in self.TAXONOMIES]
+        if has_fts:
+            tables.append('content_fts')
+        for tbl in tables:
+            cur.executemany(
+                "DELETE FROM %s WHERE source_file = ?" % tbl, stale)
+        ins_sql = "INSERT INTO content (%s) VALUES (%s)" % (
+            ', '.join(all_cols), ', '.join(['?' for _ in all_cols]))
+        cur.executemany(ins_sql, [_[1] for _ in changed.values()])
+        # Positions are not part of the row hash, since inserting an item
+        # shifts all of those after it; only those which differ are written.
+        cur.executemany(
+            "UPDATE content SET position = ? WHERE source_file = ? AND position IS NOT ?",
+            [(i, it['source_file'], i) for i, it in enumerate(items)])
+        cur.executemany(
+            "INSERT INTO content_hashes VALUES (?, ?)",
+            [(k, v[2]) for k, v in changed.items()])
+        for tbl in self.TAXONOMIES:
+            cur.executemany(
+                "INSERT INTO content_%s VALUES (?, ?, ?)" % tbl,
+                [row for v in changed.values()
+                 for row in self.item_taxons(v[0])[tbl]])
+        if has_fts:
+            cur.executemany(
+                "INSERT INTO content_fts VALUES (?, ?, ?, ?)",
+                [self.item_fts(v[0]) for v in changed.values()])
+        self.create_indexes(cur, page_cols)
+        self.conn.commit()
+        return (len(changed), len(removed))
+
+
+class TaxonomyAggregate:
+    """
+    The data behind MDContentList.taxonomy_info() for a given set of `keys`,
+    built by adding the items of the list one by one. It is kept along with
+    the other indexes of the list and is updated, rather than rebuilt, when
+    items are appended to the list.
+    """
+
+    def __init__(self, keys, tostring=None):
+        self.keys = keys
+        self.tostring = tostring
+        self.taxons = {}
+        self.slug2name = {}
+        self.seen = set()
+        self.by_item = {}
+
+    def values_of(self, item):
+        "The taxonomy values found in `item`, or None if it is unknown."
+        return self.by_item.get(id(item))
+
+    def extract(self, item):
+        pg = item['data']['page']
+        ret = []
+        for k in self.keys:
+            if k in pg:
+                if isinstance(pg[k], (str, int)):
+                    ret.append(pg[k])
+                elif isinstance(pg[k], (list, tuple)):
+                    for tx in pg[k]:
+                        if self.tostring and not isinstance(tx, (str, int)):
+                            ret.append(self.tostring(tx))
+                        else:
+                            ret.append(tx)
+                elif self.tostring:
+                    ret.append(self.tostring(pg[k]))
+        return ret
+
+    def add(self, item, values=None):
+        if values is None:
+            values = self.extract(item)
+        self.by_item[id(item)] = values
+        for tx in values:
+            slug = slugify(tx)
+            seen_key = ':'.join([slug, item['url']])
+            name = tx if tx in self.taxons else self.slug2name.get(slug)
+            if name is None:
+                self.taxons[tx] = {
+                    'name': tx,
+                    'slug': slug,
+                    'forms': [tx],
+                    'count': 1,
+                    'items': [item],
+                }
+                self.seen.add(seen_key)
+                self.slug2name[slug] = tx
+                continue
+            rec = self.taxons[name]
+            rec['count'] += 1
+            if not seen_key in self.seen:
+                rec['items'].append(item)
+                self.seen.add(seen_key)
+            if not tx in rec['forms']:
+                rec['forms'].append(tx)
+
+    def result(self, order='count', source=None):
+        """
+        A list of taxonomy records as described for
+        MDContentList.taxonomy_info(). The records are copies, so the caller
+        may modify them.
+        """
+        found = []
+        for rec in self.taxons.values():
+            rec = dict(rec)
+            rec['forms'] = list(rec['forms'])
+            rec['items'] = source._derived(rec['items']) \
+                if source is not None else MDContentList(rec['items'])
+            found.append(rec)
+        if order == 'count':
+            found.sort(key=lambda x: x['count'], reverse=True)
+        elif order in ('name', 'slug'):
+            found.sort(key=lambda x: locale.strxfrm(x[order]), reverse=False)
+        return found
+
+
+class LinkIndex:
+    """
+    Lookup tables for resolving `linkto` targets in an MDContentList without
+    applying regular expressions to every item. Names (slugs, titles and the
+    basenames of source paths and URLs) are normalized by lowercasing them and
+    treating space, underscore and hyphen as equivalent. Source paths and URLs
+    are also kept reversed in sorted lists, so that items can be found by
+    suffix using binary search.
+
+    Results are the same as those of the corresponding page_match()
+    expressions in the linkto heuristics.
+    """
+    NAME_FIELDS = ('slug', 'title', 'path', 'url')
+
+    def __init__(self, items):
+        self.items = items
+        self.names = dict([(k, {}) for k in self.NAME_FIELDS])
+        self.suffixes = {'path': [], 'url': []}
+        for i, it in enumerate(items):
+            pg = it['data']['page']
+            path = str(it.get('source_file_short') or '')
+            url = str(it.get('url') or '')
+            keys = {
+                'slug': [pg.get('slug') or ''],
+                'title': [pg.get('title') or ''],
+                'path': [], 'url': []}
+            if path.lower().endswith('.md') and '/' in path:
+                keys['path'].append(path[:-3].split('/')[-1])
+            if url.lower().endswith('.html') and '/' in url:
+                keys['url'].append(url[:-5].split('/')[-1])
+                if url.lower().endswith('/index.html'):
+                    keys['url'].append(url[:-11].split('/')[-1])
+            for k in keys:
+                for name in keys[k]:
+                    name = self.normalize(name)
+                    if not name:
+                        continue
+                    if name not in self.names[k]:
+                        self.names[k][name] = []
+                    if not i in self.names[k][name]:
+                        self.names[k][name].append(i)
+            self.suffixes['path'].append((path.lower()[::-1], i))
+            self.suffixes['url'].append((url.lower()[::-1], i))
+        for k in self.suffixes:
+            self.suffixes[k].sort()
+
+    @staticmethod
+    def normalize(name):
+        return re.sub(r'[ _-]', '-', str(name).lower())
+
+    def _collect(self, groups):
+        # The union of several lists of item positions, without duplicate URLs
+        seen = set()
+        ret = []
+        for positions in groups:
+            for i in positions:
+                it = self.items[i]
+                if it['url'] in seen:
+                    continue
+                seen.add(it['url'])
+                ret.append(it)
+        return MDContentList(ret)
+
+    def by_name(self, name):
+        """
+        Items whose slug or title is `name`, or whose source file or URL has it
+        as a basename (in that order of precedence).
+        """
+        name = self.normalize(name)
+        return self._collect(
+            [self.names[k].get(name, []) for k in self.NAME_FIELDS])
+
+    def by_suffix(self, field, suffix):
+        "Items whose `field` ('path' or 'url') ends with `suffix`."
+        entries = self.suffixes[field]
+        needle = suffix.lower()[::-1]
+        positions = []
+        start = bisect.bisect_left(entries, (needle, -1))
+        for rev, i in entries[start:]:
+            if not rev.startswith(needle):
+                break
+            positions.append(i)
+        return self._collect([sorted(positions)])
+
+
+class RenderCacheDir:
+    """
+    Content-addressed directory tree used as an alternative storage for the
+    RenderCache, e.g. for sharing it between checkouts, users or CI jobs. Each
+    entry is a file named after its key, placed in a subdirectory determined by
+    the first four hex digits of the key (e.g. `ab/cd/abcd1234...`). Files are
+    written atomically (via a temporary file and a rename), so that several
+    builds may use the same directory at once. The modification time of an
+    entry file serves as its last-access stamp.
+    """
+    MAGIC = b'WMKRC1\n'
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:4], key)
+
+    def read(self, key):
+        "Returns a tuple of (val, accessed, meta, fmt), or None."
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            accessed = os.path.getmtime(path)
+        except OSError:
+            return None
+        try:
+            if not data.startswith(self.MAGIC):
+                raise ValueError('Not a cache entry')
+            header, payload = data[len(self.MAGIC):].split(b'\n', 1)
+            header = json.loads(header)
+            if header.get('size', len(payload)) != len(payload):
+                raise ValueError('Truncated cache entry')
+            val = payload.decode('utf-8') if header.get('text') else payload
+            return (val, accessed, header.get('meta'), header.get('fmt'))
+        except (ValueError, AttributeError):
+            # Corrupt or truncated entry; treated as a cache miss
+            self.remove(key)
+            return None
+
+    def write(self, key, val, meta=None, fmt=None):
+        if self.readonly:
+            return
+        path = self.entry_path(key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+        is_text = isinstance(val, str)
+        payload = val.encode('utf-8') if is_text else (val or b'')
+        header = json.dumps({'fmt': fmt, 'meta': meta, 'text': is_text,
+                             'size': len(payload)})
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.MAGIC + header.encode('utf-8') + b'\n')
+                f.write(payload)
+            os.replace(tmpname, path)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+    def touch(self, key):
+        if self.readonly:
+            return
+        try:
+            os.utime(self.entry_path(key))
+        except OSError:
+            pass
+
+    def remove(self, key):
+        if self.readonly:
+            return
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        "Yields (path, size, mtime) for each entry."
+        for root, dirs, files in os.walk(self.path):
+            for fn in files:
+                if fn.startswith('.'):
+                    continue
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield (path, st.st_size, st.st_mtime)
+
+    def stats(self):
+        entries = list(self.entries())
+        mtimes = [_[2] for _ in entries]
+        data_size = sum([_[1] for _ in entries])
+        # Entry files have no separate creation stamp, so the oldest entry is
+        # the one with the earliest modification time.
+        return {'filename': self.path, 'file_size': data_size,
+                'entries': len(entries), 'data_size': data_size,
+                'oldest': min(mtimes) if mtimes else None,
+                'newest': max(mtimes) if mtimes else None,
+                'least_recent': min(mtimes) if mtimes else None}
+
+    def prune(self, max_age=None, max_size=None):
+        if self.readonly:
+            return 0
+        entries = sorted(self.entries(), key=lambda x: x[2], reverse=True)
+        cutoff = time.time() - float(max_age) * 86400 if max_age else None
+        total = 0
+        removed = 0
+        for path, size, mtime in entries:
+            total += size
+            if (cutoff and mtime < cutoff) or (max_size and total > max_size):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def clear(self):
+        "Removes all entries; returns their number."
+        if self.readonly:
+            return 0
+        removed = 0
+        for path, size, mtime in list(self.entries()):
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
 
 
 class RenderCache:
     """
     Extremely simple cache for rendered HTML, keyed on a SHA1 hash of the
     markdown contents and the serialized rendering options.
-    May become invalid if shortcodes change without changes in the markdown
-    source.
+
+    Values are transparently compressed with zstd (if available) or zlib,
+    depending on the `compression` setting (see `configure()`). The `fmt`
+    column records how each value is stored, so that entries written with a
+    different setting (or by an older version of wmk) remain readable.
+
+    An entry may also carry metadata (`meta`), notably a record of the files it
+    depends upon (`deps`, a mapping from filename to SHA1 hash; see
+    `file_hash()`). An entry is only considered valid as long as none of these
+    files have changed. Filenames are recorded relative to the project
+    directory (or the wmk directory) so that entries remain valid elsewhere.
+
+    Entries carry a last-access stamp (updated at most once a day) and their
+    size, so that the cache can be pruned by age and/or total size via the
+    `prune()` classmethod. Database connections are shared between instances
+    (per thread) so as to avoid reopening the file for each lookup.
+
+    By default the cache is a SQLite file in the `tmp` subdirectory of the
+    project. If a `directory` has been configured, a RenderCacheDir at that
+    location is used instead.
     """
     SQL_INIT = """
       CREATE TABLE cache (
           key varchar not null primary key,
           val text,
           creat int not null default (strftime('%s', 'now')),
-          upd int not null default (strftime('%s', 'now'))
+          upd int not null default (strftime('%s', 'now')),
+          accessed int,
+          size int,
+          meta text,
+          fmt int
       );
     """
-    SQL_GETROW = "SELECT val FROM cache WHERE key = :key"
-    SQL_INS = "INSERT INTO cache (key, val) VALUES (:key, :val)"
-    SQL_UPD = "UPDATE cache SET val = :val, upd = strftime('%s', 'now') WHERE key = :key"
+    SQL_MIGRATE = {
+        'accessed': "ALTER TABLE cache ADD COLUMN accessed int",
+        'size': "ALTER TABLE cache ADD COLUMN size int",
+        'meta': "ALTER TABLE cache ADD COLUMN meta text",
+        'fmt': "ALTER TABLE cache ADD COLUMN fmt int",
+    }
+    SQL_GETROW = "SELECT val, accessed, meta, fmt FROM cache WHERE key = :key"
+    SQL_INS = """
+      INSERT INTO cache (key, val, accessed, size, meta, fmt)
+      VALUES (:key, :val, strftime('%s', 'now'), :size, :meta, :fmt)"""
+    SQL_UPD = """
+      UPDATE cache SET val = :val, size = :size, meta = :meta, fmt = :fmt,
+        upd = strftime('%s', 'now'), accessed = strftime('%s', 'now')
+      WHERE key = :key"""
+    SQL_TOUCH = "UPDATE cache SET accessed = strftime('%s', 'now') WHERE key = :key"
+    # Only refresh the access stamp of an entry if it is older than this
+    TOUCH_INTERVAL = 86400
+    # Storage formats for values (NULL means the same as FMT_PLAIN)
+    FMT_PLAIN = 0
+    FMT_ZLIB = 1
+    FMT_ZSTD = 2
+    # Values shorter than this (in bytes) are not worth compressing
+    MIN_COMPRESS_SIZE = 256
+    WMK_HOME = os.path.dirname(os.path.realpath(__file__))
+    compression = 'auto'
+    directory = None
+    readonly = False
+
+    _local = threading.local()
+    _checked = set()
 
     def __init__(self, doc, optstr='', projdir=None):
+        self.projdir = projdir
+        if self.directory:
+            self.store = RenderCacheDir(self.directory, self.readonly)
+            self.filename = None
+        else:
+            self.store = None
+            self.filename = self.cache_filename(projdir, create_dir=True)
+            self._connect(self.filename)
+        self.in_cache = False
+        self.row_exists = False
+        self.meta = {}
+        self.key = hashlib.sha1(
+            doc.encode('utf-8') + str(optstr).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def configure(cls, compression=None, directory=None, readonly=None):
+        """
+        Class-wide settings. `compression` is one of 'auto' (zstd if available,
+        otherwise zlib), 'zstd', 'zlib' or 'none'. A boolean True means 'auto'
+        and False means 'none'. If `directory` is set, the cache is stored in a
+        RenderCacheDir there rather than in the SQLite file of the project
+        (passing an empty string reverts to the latter). If `readonly` is True,
+        nothing is written to the cache.
+        """
+        if compression is not None:
+            if compression is True:
+                compression = 'auto'
+            elif not compression:
+                compression = 'none'
+            compression = str(compression).lower()
+            if compression not in ('auto', 'zstd', 'zlib', 'none'):
+                raise ValueError(
+                    'Unknown cache compression setting: %s' % compression)
+            if compression == 'zstd' and not _zstd:
+                print("WARNING: zstd not available; using zlib for cache compression")
+                compression = 'zlib'
+            cls.compression = compression
+        if directory is not None:
+            cls.directory = directory or None
+        if readonly is not None:
+            cls.readonly = bool(readonly)
+
+    @classmethod
+    def encode_value(cls, val):
+        "Returns a tuple of (stored_value, fmt)."
+        if not isinstance(val, str):
+            return (val, cls.FMT_PLAIN)
+        data = val.encode('utf-8')
+        if cls.compression == 'none' or len(data) < cls.MIN_COMPRESS_SIZE:
+            return (val, cls.FMT_PLAIN)
+        elif _zstd and cls.compression in ('auto', 'zstd'):
+            return (_zstd_compress(data), cls.FMT_ZSTD)
+        return (zlib.compress(data), cls.FMT_ZLIB)
+
+    @classmethod
+    def decode_value(cls, val, fmt):
+        """
+        Returns the original value, or raises ValueError if the format is
+        unknown or unsupported.
+        """
+        if not fmt:
+            return val
+        try:
+            if fmt == cls.FMT_ZLIB:
+                return zlib.decompress(val).decode('utf-8')
+            elif fmt == cls.FMT_ZSTD and _zstd:
+                return _zstd_decompress(val).decode('utf-8')
+        except Exception as e:
+            # E.g. a truncated entry
+            raise ValueError('Invalid cache value: %s' % e)
+        raise ValueError('Unsupported cache value format: %s' % fmt)
+
+    @staticmethod
+    def cache_filename(projdir=None, create_dir=False):
         if not projdir:
             cachedir = '/tmp'
         else:
             cachedir = os.path.join(projdir, 'tmp')
-            if not os.path.exists(cachedir):
+            if create_dir and not os.path.exists(cachedir):
                 os.mkdir(cachedir)
-        self.filename = os.path.join(
-            cachedir, 'wmk_render_cache.%d.db') % os.getuid()
-        need_init = not os.path.exists(self.filename)
-        self.db = sqlite3.connect(self.filename)
-        self.cur = self.db.cursor()
-        self.in_cache = False
+        return os.path.join(cachedir, 'wmk_render_cache.%d.db') % os.getuid()
+
+    @classmethod
+    def _connect(cls, filename):
+        conns = getattr(cls._local, 'connections', None)
+        if conns is None:
+            conns = cls._local.connections = {}
+        if filename in conns:
+            return conns[filename]
+        need_init = not os.path.exists(filename)
+        db = sqlite3.connect(filename, timeout=30)
+        cur = db.cursor()
         if need_init:
-            self.cur.execute(self.SQL_INIT)
-        self.key = hashlib.sha1(
-            doc.encode('utf-8') + str(optstr).encode('utf-8')).hexdigest()
+            cur.execute(cls.SQL_INIT)
+            db.commit()
+        elif filename not in cls._checked:
+            cur.execute("PRAGMA table_info(cache)")
+            cols = set([_[1] for _ in cur.fetchall()])
+            for col in cls.SQL_MIGRATE:
+                if col not in cols:
+                    cur.execute(cls.SQL_MIGRATE[col])
+            if 'size' not in cols:
+                cur.execute(
+                    "UPDATE cache SET size = length(CAST(val AS BLOB))")
+            db.commit()
+        cls._checked.add(filename)
+        conns[filename] = db
+        return db
+
+    @property
+    def db(self):
+        "The database connection for the current thread."
+        return self._connect(self.filename) if self.filename else None
+
+    def portable_path(self, fn):
+        "Path relative to the project (or wmk) directory, if applicable."
+        for prefix, base in (('', self.projdir), ('<wmk>/', self.WMK_HOME)):
+            if base and fn.startswith(base.rstrip('/') + '/'):
+                return prefix + os.path.relpath(fn, base)
+        return fn
+
+    def full_path(self, fn):
+        "The inverse of portable_path()."
+        if fn.startswith('<wmk>/'):
+            return os.path.join(self.WMK_HOME, fn[6:])
+        elif not os.path.isabs(fn) and self.projdir:
+            return os.path.join(self.projdir, fn)
+        return fn
+
+    def dependencies(self):
+        "Full paths of the files which the current entry depends upon."
+        return [self.full_path(_) for _ in (self.meta.get('deps') or {})]
+
+    def _fetch(self):
+        if self.store:
+            return self.store.read(self.key)
+        cur = self.db.cursor()
+        cur.execute(self.SQL_GETROW, {'key': self.key})
+        return cur.fetchone()
+
+    def _touch(self):
+        if self.store:
+            self.store.touch(self.key)
+        elif not self.readonly:
+            db = self.db
+            db.execute(self.SQL_TOUCH, {'key': self.key})
+            db.commit()
 
     def get_cache(self):
-        self.cur.execute(self.SQL_GETROW, {'key': self.key})
-        row = self.cur.fetchone()
-        self.in_cache = True if row else False
-        return row[0] if row else None
+        row = self._fetch()
+        self.row_exists = self.in_cache = True if row else False
+        self.meta = json.loads(row[2]) if row and row[2] else {}
+        if row and not self.deps_unchanged(self.meta.get('deps')):
+            self.in_cache = False
+            return None
+        if not row:
+            return None
+        try:
+            val = self.decode_value(row[0], row[3])
+        except ValueError:
+            # E.g. compressed with zstd by another installation
+            self.in_cache = False
+            return None
+        if (row[1] or 0) < time.time() - self.TOUCH_INTERVAL:
+            self._touch()
+        return val
+
+    def deps_unchanged(self, deps):
+        if not deps:
+            return True
+        for fn in deps:
+            if file_hash(self.full_path(fn)) != deps[fn]:
+                return False
+        return True
 
-    def write_cache(self, html):
-        if self.in_cache:
+    def write_cache(self, html, meta=None):
+        """
+        Store `html` in the cache. If `meta` is given, it is a dict that is
+        stored along with it. If it contains the key `deps`, its value should
+        be a list of filenames which the value depends upon; these are stored
+        along with their current hashes.
+        """
+        if self.in_cache or self.readonly:
             return
+        meta = dict([(k, v) for k, v in (meta or {}).items() if v])
+        if meta.get('deps'):
+            meta['deps'] = dict([
+                (self.portable_path(fn), file_hash(fn)) for fn in meta['deps']])
+        metastr = json.dumps(meta, sort_keys=True) if meta else None
         prev_val = self.get_cache()
-        if prev_val is None:
-            self.cur.execute(self.SQL_INS, {'key': self.key, 'val': html})
-            self.cur.execute('COMMIT')
-            self.in_cache = True
-        elif prev_val != html:
-            # An update should actually never happen; if it does, the optstr
-            # will not have been based on all relevant options
-            self.cur.execute(self.SQL_UPD, {'key': self.key, 'val': html})
-            self.cur.execute('COMMIT')
+        stored, fmt = self.encode_value(html)
+        if prev_val is not None and prev_val == html and self.in_cache:
+            return
+        if self.store:
+            self.store.write(self.key, stored, metastr, fmt)
+        else:
+            size = len(stored.encode('utf-8')) if isinstance(stored, str) else len(stored or '')
+            rec = {'key': self.key, 'val': stored, 'size': size,
+                   'meta': metastr, 'fmt': fmt}
+            # An update normally only happens when a dependency has changed.
+            # Otherwise, the optstr will not have been based on all relevant
+            # options.
+            db = self.db
+            db.execute(self.SQL_UPD if self.row_exists else self.SQL_INS, rec)
+            db.commit()
+        self.in_cache = self.row_exists = True
+        self.meta = json.loads(metastr) if metastr else {}
+
+    @classmethod
+    def stats(cls, projdir=None):
+        """
+        Information about the cache for the given project directory, as a dict
+        with the keys filename, file_size, entries, data_size, oldest,
+        newest and least_recent (the latter three are unix timestamps).
+        """
+        if cls.directory:
+            return RenderCacheDir(cls.directory, readonly=True).stats()
+        filename = cls.cache_filename(projdir)
+        ret = {'filename': filename, 'file_size': 0, 'entries': 0,
+               'data_size': 0, 'oldest': None, 'newest': None,
+               'least_recent': None}
+        if not os.path.exists(filename):
+            return ret
+        ret['file_size'] = os.path.getsize(filename)
+        cur = cls._connect(filename).cursor()
+        cur.execute("""
+          SELECT count(*), sum(size), min(creat), max(upd),
+                 min(coalesce(accessed, upd))
+          FROM cache""")
+        row = cur.fetchone()
+        for i, k in enumerate(
+                ('entries', 'data_size', 'oldest', 'newest', 'least_recent')):
+            ret[k] = row[i]
+        ret['data_size'] = ret['data_size'] or 0
+        return ret
+
+    @classmethod
+    def prune(cls, projdir=None, max_age=None, max_size=None, vacuum=None):
+        """
+        Remove entries that have not been accessed for `max_age` days and/or
+        the least recently used entries until the total size of the cached
+        data is at most `max_size` bytes. Returns the number of removed
+        entries. The database file is vacuumed afterwards if `vacuum` is True,
+        or (if it is None) when the removed entries account for a substantial
+        share of the data.
+        """
+        if not (max_age or max_size) or cls.readonly:
+            return 0
+        if cls.directory:
+            return RenderCacheDir(cls.directory).prune(max_age, max_size)
+        filename = cls.cache_filename(projdir)
+        if not os.path.exists(filename):
+            return 0
+        db = cls._connect(filename)
+        cur = db.cursor()
+        cur.execute("SELECT count(*), coalesce(sum(size), 0) FROM cache")
+        count_before, size_before = cur.fetchone()
+        if max_age:
+            cutoff = int(time.time() - float(max_age) * 86400)
+            cur.execute(
+                "DELETE FROM cache WHERE coalesce(accessed, upd) < ?", (cutoff, ))
+        if max_size:
+            cur.execute("""
+              SELECT key, size FROM cache
+              ORDER BY coalesce(accessed, upd) DESC, upd DESC""")
+            total = 0
+            doomed = []
+            for key, size in cur.fetchall():
+                total += size or 0
+                if total > max_size:
+                    doomed.append((key, ))
+            cur.executemany("DELETE FROM cache WHERE key = ?", doomed)
+        db.commit()
+        cur.execute("SELECT count(*), coalesce(sum(size), 0) FROM cache")
+        count_after, size_after = cur.fetchone()
+        removed = count_before - count_after
+        if vacuum is None:
+            vacuum = removed and (size_before - size_after) > size_before / 4
+        if vacuum:
+            cur.execute('VACUUM')
+        return removed
+
+    @classmethod
+    def clear(cls, projdir=None):
+        """
+        Remove all entries, i.e. the database file or (for a cache directory)
+        the entry files. Returns the number of removed entries.
+        """
+        if cls.readonly:
+            return 0
+        if cls.directory:
+            return RenderCacheDir(cls.directory).clear()
+        filename = cls.cache_filename(projdir)
+        if not os.path.exists(filename):
+            return 0
+        removed = cls.stats(projdir)['entries']
+        conns = getattr(cls._local, 'connections', None)
+        if conns and filename in conns:
+            conns.pop(filename).close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+        return removed
+
+
+class BackgroundJobs:
+    """
+    A pool of worker threads for jobs which may run in parallel with the rest
+    of the build (such as writing extra pandoc output formats), but must be
+    finished before the build is considered done. Call `configure()` with the
+    desired number of workers, `submit()` for each job and `wait()` at the end;
+    the latter re-raises the first exception raised by any of the jobs. With
+    fewer than two workers, jobs run immediately in the calling thread. Jobs
+    which nobody has waited for are waited for when wmk exits.
+    """
+    workers = 1
+    _executor = None
+    _futures = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, workers=1):
+        cls.workers = int(workers or 1)
+
+    @classmethod
+    def submit(cls, fn, *args, **kwargs):
+        if cls.workers < 2:
+            fn(*args, **kwargs)
+            return
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=cls.workers)
+                atexit.register(cls._wait_at_exit)
+            cls._futures.append(cls._executor.submit(fn, *args, **kwargs))
+
+    @classmethod
+    def wait(cls):
+        with cls._lock:
+            futures = cls._futures
+            cls._futures = []
+        for fut in futures:
+            fut.result()
+
+    @classmethod
+    def _wait_at_exit(cls):
+        try:
+            cls.wait()
+        except Exception as e:
+            print("WARNING: Background job failed: %s" % e)
+
+
+class PandocServer:
+    """
+    Client for a long-running `pandoc server` process (available in pandoc 3.0
+    and later), which is started on a free local port the first time it is
+    needed and stopped when wmk exits. Alternatively, `url` may point to an
+    already running server, which is then left alone.
+
+    Use `PandocServer.configure(settings)` followed by `PandocServer.get()`,
+    which returns None if no server is configured or if it could not be
+    started. `convert()` returns None when a conversion cannot be done by the
+    server (e.g. because of unsupported options or output formats), in which
+    case the caller is expected to fall back to pypandoc.
+    """
+    # Input formats which must be sent base64-encoded
+    BINARY_INPUT = ('docx', 'odt', 'epub', 'pptx', 'xlsx')
+    # Output formats which the server returns base64-encoded
+    BINARY_OUTPUT = ('docx', 'odt', 'epub', 'epub2', 'epub3', 'pptx')
+    # pandoc command line options which map directly onto server options
+    FLAG_OPTIONS = {
+        '--toc': 'table-of-contents',
+        '--table-of-contents': 'table-of-contents',
+        '-s': 'standalone',
+        '--standalone': 'standalone',
+        '-N': 'number-sections',
+        '--number-sections': 'number-sections',
+        '--section-divs': 'section-divs',
+        '--ascii': 'ascii',
+        '--html-q-tags': 'html-q-tags',
+        '--reference-links': 'reference-links',
+        '--strip-comments': 'strip-comments',
+    }
+    VALUE_OPTIONS = {
+        '--toc-depth': ('toc-depth', int),
+        '--shift-heading-level-by': ('shift-heading-level-by', int),
+        '--columns': ('columns', int),
+        '--tab-stop': ('tab-stop', int),
+        '--dpi': ('dpi', int),
+        '--epub-chapter-level': ('epub-chapter-level', int),
+        '--wrap': ('wrap', str),
+        '--id-prefix': ('identifier-prefix', str),
+        '--title-prefix': ('title-prefix', str),
+        '--highlight-style': ('highlight-style', str),
+        '--top-level-division': ('top-level-division', str),
+        '--email-obfuscation': ('email-obfuscation', str),
+        '--default-image-extension': ('default-image-extension', str),
+        '--track-changes': ('track-changes', str),
+    }
+    settings = None
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, url=None, command='pandoc', timeout=60):
+        self.url = url.rstrip('/') if url else None
+        self.command = command
+        self.timeout = int(timeout)
+        self.process = None
+        self.available = False
+        self.version = None
+
+    @classmethod
+    def configure(cls, settings):
+        """
+        `settings` is either a boolean or a dict with the optional keys `url`,
+        `command` and `timeout` (in seconds, per request).
+        """
+        if settings and not isinstance(settings, dict):
+            settings = {}
+        elif not settings:
+            settings = None
+        with cls._lock:
+            if settings != cls.settings and cls._instance:
+                cls._instance.stop()
+                cls._instance = None
+            cls.settings = settings
+
+    @classmethod
+    def get(cls):
+        "The running server, if any."
+        if cls.settings is None:
+            return None
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls(**cls.settings)
+                cls._instance.start()
+        return cls._instance if cls._instance.available else None
+
+    def start(self):
+        if not self.url:
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            self.url = 'http://127.0.0.1:%d' % port
+            try:
+                self.process = subprocess.Popen(
+                    [self.command, 'server', '--port', str(port),
+                     '--timeout', str(self.timeout)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                print("WARNING: could not start pandoc server:", str(e))
+                return
+            atexit.register(self.stop)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if self.process and self.process.poll() is not None:
+                break
+            try:
+                with urllib.request.urlopen(self.url + '/version', timeout=1) as r:
+                    self.version = r.read().decode('utf-8').strip()
+                self.available = True
+                return
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        print("WARNING: pandoc server not available; using pypandoc instead")
+        self.stop()
+
+    def stop(self):
+        self.available = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    @classmethod
+    def request_options(cls, extra_args):
+        """
+        Translates pandoc command line options into a dict of server options,
+        or returns None if any of them is unsupported.
+        """
+        ret = {}
+        args = list(extra_args or [])
+        while args:
+            arg = str(args.pop(0))
+            if arg in cls.FLAG_OPTIONS:
+                ret[cls.FLAG_OPTIONS[arg]] = True
+                continue
+            opt, eq, val = arg.partition('=')
+            if opt in ('-V', '-M', '--template') \
+                    or opt in cls.VALUE_OPTIONS or opt in ('--variable', '--metadata'):
+                if not eq:
+                    if not args:
+                        return None
+                    val = str(args.pop(0))
+            else:
+                return None
+            if opt in cls.VALUE_OPTIONS:
+                key, typ = cls.VALUE_OPTIONS[opt]
+                try:
+                    ret[key] = typ(val)
+                except ValueError:
+                    return None
+            elif opt == '--template':
+                # The server has no access to the file system
+                try:
+                    with open(val) as f:
+                        ret['template'] = f.read()
+                except OSError:
+                    return None
+                ret['standalone'] = True
+            else:
+                key = 'variables' if opt in ('-V', '--variable') else 'metadata'
+                k, sep, v = re.split(r'([=:])', val, maxsplit=1) \
+                    if re.search(r'[=:]', val) else (val, '', True)
+                ret.setdefault(key, {})[k] = v
+        return ret
+
+    def convert(self, source, to, fmt, extra_args=None, is_file=False):
+        """
+        Convert `source` (text, or the name of a file if `is_file` is true)
+        from `fmt` into `to`. Returns text, bytes for binary output formats,
+        or None if the conversion could not be done by the server.
+        """
+        base_to = re.split(r'[+-]', to, maxsplit=1)[0]
+        base_from = re.split(r'[+-]', fmt or 'markdown', maxsplit=1)[0]
+        if base_to == 'pdf':
+            return None
+        opts = self.request_options(extra_args)
+        if opts is None:
+            return None
+        if is_file:
+            with open(source, 'rb') as f:
+                source = f.read()
+        if base_from in self.BINARY_INPUT:
+            if isinstance(source, str):
+                source = source.encode('utf-8')
+            source = base64.b64encode(source).decode('ascii')
+        elif isinstance(source, bytes):
+            source = source.decode('utf-8')
+        opts.update({'text': source, 'from': fmt or 'markdown', 'to': to})
+        req = urllib.request.Request(
+            self.url, data=json.dumps(opts).encode('utf-8'), method='POST',
+            headers={'Content-Type': 'application/json',
+                     'Accept': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as r:
+                res = json.loads(r.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+        if not isinstance(res, dict) or res.get('error') or 'output' not in res:
+            return None
+        if res.get('base64'):
+            return base64.b64decode(res['output'])
+        return res['output']
 
 
 class NavBase: